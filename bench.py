@@ -0,0 +1,261 @@
+"""Time the lap simulators stage by stage and check their results against golden values.
+
+Each stage is timed as the best of a few runs and then run once more under
+tracemalloc for its peak memory, which NumPy arrays report to. Tracks are
+built from DXF files through every stage of dxf_to_tck.py, or read from a
+spline (.npy) or sectioned (.npz) file, and simulated at every station
+spacing given, optionally repeated over several laps to scale up the station
+count. The lap time at each spacing is compared with bench_golden.json, and
+the stage times with an earlier run when one is given, so a change that
+slows a stage down or moves a result shows up in the exit status.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import piecewise
+import pointmass_circuit as circuit
+import telemetry
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_golden.json')
+
+# bundled inputs benchmarked by default, with whether they form a closed lap
+INPUTS = (('endurancemichigan2018.dxf', True), ('accel.npy', False))
+DELTAS = (0.1, 0.05, 0.01)
+
+
+def measure(func, setup=tuple, repeat=3, memory=True):
+    """Return the result of func(*setup()), its best time in seconds and its peak memory in MB.
+
+    setup is called before every run and is not timed, so a stage that
+    changes its inputs in place gets fresh ones each time.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    peak = None
+    if memory:
+        args = setup()
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, best, peak
+
+
+def record(stage, case, seconds, peak, **extra):
+    """Return one timing record, and report it on stderr."""
+    print("%-14s %-44s %9.4f s %s" % (stage, case, seconds, '' if peak is None else '%8.1f MB' % peak),
+          file=sys.stderr)
+    return dict({'stage': stage, 'case': case, 'seconds': seconds, 'peak_mb': peak}, **extra)
+
+
+def bench_dxf(filename, closed, delta, out_dir, repeat=3, memory=True):
+    """Time every stage of turning a DXF into track files, and return the records and the files written."""
+    import dxf_to_tck
+
+    name = os.path.basename(filename)
+    stem = os.path.join(out_dir, os.path.splitext(name)[0])
+    records = []
+    modelspace, t, m = measure(dxf_to_tck.read, lambda: (filename,), repeat, memory)
+    records.append(record('dxf_parse', name, t, m, items=len(modelspace)))
+    sections, t, m = measure(dxf_to_tck.chain, lambda: (modelspace,), repeat, memory)
+    records.append(record('chain', name, t, m, items=len(sections)))
+
+    points, t, m = measure(dxf_to_tck.track_points, lambda: (dxf_to_tck.track_list(sections), delta, closed),
+                           repeat, memory)
+    records.append(record('track_points', name, t, m, delta=delta, items=len(points[0])))
+    tck, t, m = measure(dxf_to_tck.fit, lambda: points, repeat, memory)
+    records.append(record('spline_fit', name, t, m, delta=delta, items=len(points[0])))
+    np.save(stem + '.npy', np.array(tck, dtype=object))
+
+    trk, t, m = measure(piecewise.from_sections, lambda: (sections, closed), repeat, memory)
+    records.append(record('sections', name, t, m, items=len(trk['length'])))
+    piecewise.save(stem + '.npz', trk)
+    return records, [(name + '/spline', stem + '.npy'), (name + '/sections', stem + '.npz')]
+
+
+def repeat_laps(track, laps):
+    """Return a track that goes round the given one laps times."""
+    if laps == 1:
+        return track
+    tiled = {k: np.tile(track[k], laps) for k in ('x', 'y', 'len', 'radius')}
+    tiled['dist'] = np.cumsum(tiled['len'])
+    tiled['dd'] = track['dd']
+    return tiled
+
+
+def bench_lap(name, filename, dd, laps=(1,), repeat=3, memory=True, veh=circuit.VEHICLE):
+    """Time discretizing a track file and each pass of the circuit solver, and return the records and lap time."""
+    case = '%s:d=%g' % (name, dd)
+    records = []
+    track, t, m = measure(circuit.discretize, lambda: (filename, dd), repeat, memory)
+    records.append(record('discretize', case, t, m, delta=dd, stations=len(track['len'])))
+
+    powertrain = circuit.make_powertrain(veh)
+    ggv = circuit.make_ggv(veh, powertrain)
+    lap_time = None
+    for n_laps in laps:
+        trk = repeat_laps(track, n_laps)
+        label = case if n_laps == 1 else '%s x%d' % (case, n_laps)
+        extra = {'delta': dd, 'laps': n_laps, 'stations': len(trk['len'])}
+
+        _, t, m = measure(circuit.corner_speeds, lambda: (trk['radius'], veh), repeat, memory)
+        records.append(record('corner_speeds', label, t, m, **extra))
+
+        def fresh():
+            return (telemetry_buffer(trk), circuit.solver_state(trk, veh), veh, powertrain, ggv)
+
+        _, t, m = measure(circuit.forward_pass, fresh, repeat, memory)
+        records.append(record('forward_pass', label, t, m, **extra))
+
+        def swept():
+            args = fresh()
+            circuit.forward_pass(*args)
+            return args
+
+        _, t, m = measure(circuit.backward_pass, swept, repeat, memory)
+        records.append(record('backward_pass', label, t, m, **extra))
+
+        s, t, m = measure(circuit.simulate, lambda: (trk, veh, circuit.SUMMARY, None, powertrain, ggv),
+                          repeat, memory)
+        records.append(record('simulate', label, t, m, **extra))
+        if n_laps == 1:
+            lap_time = float(s['t'][-1])
+    return records, case, lap_time
+
+
+def telemetry_buffer(track):
+    """Return an empty buffer of the channels summary() needs."""
+    return telemetry.allocate(len(track['len']), circuit.SUMMARY, circuit.CHANNELS, circuit.CHANNEL_TYPES)
+
+
+def bench_accel(repeat=3, memory=True):
+    """Time the adaptive straight line acceleration run, and return its record and finish time."""
+    import pointmass_accel
+
+    data, t, m = measure(lambda: pointmass_accel.integrate(channels=('time',)), tuple, repeat, memory)
+    return record('accel', 'pointmass_accel', t, m, steps=len(data)), float(data['time'][-1])
+
+
+def check(results, golden, rtol):
+    """Compare each result with its golden value and return one check per result."""
+    checks = []
+    for case, value in results.items():
+        expected = golden.get(case)
+        if expected is None:
+            status = 'new'
+        elif np.isclose(value, expected, rtol=rtol, atol=0):
+            status = 'ok'
+        else:
+            status = 'fail'
+        checks.append({'case': case, 'value': value, 'golden': expected, 'status': status})
+    return checks
+
+
+def compare(records, baseline, slowdown):
+    """Flag the stages that got more than slowdown times slower than in a baseline run."""
+    before = {(r['stage'], r['case']): r['seconds'] for r in baseline['records']}
+    slow = []
+    for r in records:
+        old = before.get((r['stage'], r['case']))
+        if old is not None and r['seconds'] > slowdown * old:
+            slow.append({'stage': r['stage'], 'case': r['case'], 'seconds': r['seconds'], 'baseline': old})
+    return slow
+
+
+def environment():
+    """Describe what the benchmark ran on."""
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'numba': numba_version,
+            'jit': numba_version is not None and os.environ.get('NUMBA_DISABLE_JIT', '0') == '0',
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='*', help='DXF, spline (.npy) or sectioned (.npz) tracks, by default the bundled ones. ')
+    parser.add_argument('--open', action='store_true', help='Treat DXF inputs as open rather than closed laps. ')
+    parser.add_argument('-d', '--delta', default=','.join(map(str, DELTAS)), help='A comma separated list of station spacings. ')
+    parser.add_argument('--fit-delta', type=float, default=0.01, help='The point spacing of the spline fit for DXF inputs. ')
+    parser.add_argument('-l', '--laps', default='1', help='A comma separated list of lap counts to scale the solver stages by. ')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Time each stage as the best of this many runs. ')
+    parser.add_argument('--no-memory', action='store_true', help='Skip measuring peak memory. ')
+    parser.add_argument('--no-accel', action='store_true', help='Skip the straight line acceleration run. ')
+    parser.add_argument('-g', '--golden', default=GOLDEN, help='The JSON file of golden results. ')
+    parser.add_argument('--rtol', type=float, default=1e-6, help='The relative tolerance of the golden checks. ')
+    parser.add_argument('--update-golden', action='store_true', help='Store the results as the new golden values. ')
+    parser.add_argument('-b', '--baseline', default=None, help='An earlier output to compare the stage times with. ')
+    parser.add_argument('--slowdown', type=float, default=1.25, help='Flag stages this many times slower than the baseline. ')
+    parser.add_argument('-o', '--output', default=None, help='The JSON file to write results to, by default stdout. ')
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    inputs = [(f, not args.open) for f in args.inputs] or [(os.path.join(here, f), c) for f, c in INPUTS]
+    deltas = [float(d) for d in args.delta.split(',')]
+    laps = [int(n) for n in args.laps.split(',')]
+    memory = not args.no_memory
+
+    records, results = [], {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for filename, closed in inputs:
+            if filename.endswith('.dxf'):
+                recs, tracks = bench_dxf(filename, closed, args.fit_delta, tmp, args.repeat, memory)
+                records += recs
+            else:
+                tracks = [(os.path.basename(filename), filename)]
+            for name, path in tracks:
+                for dd in deltas:
+                    recs, case, lap_time = bench_lap(name, path, dd, laps, args.repeat, memory)
+                    records += recs
+                    results[case] = lap_time
+    if not args.no_accel:
+        rec, finish = bench_accel(args.repeat, memory)
+        records.append(rec)
+        results['pointmass_accel'] = finish
+
+    golden = {}
+    if os.path.exists(args.golden):
+        with open(args.golden) as f:
+            golden = json.load(f)
+    report = {'environment': environment(),
+              'records': records,
+              'checks': check(results, golden, args.rtol)}
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['slow'] = compare(records, json.load(f), args.slowdown)
+
+    if args.update_golden:
+        with open(args.golden, 'w') as f:
+            json.dump(dict(golden, **results), f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    failed = [c['case'] for c in report['checks'] if c['status'] == 'fail']
+    for c in failed:
+        print("golden check failed: %s" % c, file=sys.stderr)
+    for s in report.get('slow', []):
+        print("slower than baseline: %s %s" % (s['stage'], s['case']), file=sys.stderr)
+    if failed or report.get('slow'):
+        sys.exit(1)
@@ -0,0 +1,180 @@
+"""Score a vehicle over the FSAE dynamic events.
+
+Acceleration, skidpad, autocross and endurance are all run for one vehicle
+definition, pointmass_circuit.VEHICLE by default, and their times are
+converted into competition points. The powertrain tables and g-g-speed
+envelopes of the vehicle are built once and shared by every event, as are
+the discretized tracks, so an endurance run on the autocross track reuses
+its stations and racing line. The events then run concurrently on a thread
+pool, and with Numba, whose kernels release the GIL, a full score costs
+about as much as its slowest event.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import json
+import threading
+import numpy as np
+import pointmass_circuit as circuit
+import racingline
+import stint
+
+EVENTS = ('accel', 'skidpad', 'autocross', 'endurance')
+
+# acceleration run length in meters
+ACCEL_LENGTH = 75.
+# inner diameter of the skidpad circles in meters, the car is timed on one lap each way round
+SKIDPAD_DIAMETER = 15.25
+
+# FSAE scoring of each event as (points for time, points for finishing, ratio, power), see points()
+SCORING = {'accel': (95.5, 4.5, 1.5, 1),
+           'skidpad': (71.5, 3.5, 1.25, 2),
+           'autocross': (118.5, 6.5, 1.45, 1),
+           'endurance': (250., 25., 1.45, 1)}
+
+# best times in seconds scored against, the autocross one for a lap and the endurance
+# one for the whole event around the bundled Michigan endurance layout
+BEST = {'accel': 3.9,
+        'skidpad': 4.9,
+        'autocross': 90.,
+        'endurance': 1300.}
+
+
+def points(event, t, best=BEST):
+    """Return the points a time scores in an event, given the best time of the competition.
+
+    A time t between the best time and ratio times it scores
+    points * ((t_max / t)**power - 1) / ((t_max / t_best)**power - 1) on top
+    of the points for finishing, and a slower time only scores those.
+    """
+    scale, finishing, ratio, power = SCORING[event]
+    t_best = min(best[event], t)
+    t_max = ratio * best[event]
+    if t >= t_max:
+        return finishing
+    return scale * ((t_max / t)**power - 1) / ((t_max / t_best)**power - 1) + finishing
+
+
+class Envelopes:
+    """The powertrain tables of one vehicle and its g-g-speed envelope at each mass.
+
+    Calling it like circuit.make_ggv() returns the envelope of a vehicle that
+    differs from the base one in mass at most, building it on first use, so
+    the events share the tables as the endurance car burns fuel.
+    """
+
+    def __init__(self, veh):
+        self.veh = veh
+        self.powertrain = circuit.make_powertrain(veh)
+        self.ggvs = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, veh=None, powertrain=None):
+        mass = (veh or self.veh)['VEHICLE_MASS']
+        with self.lock:
+            if mass not in self.ggvs:
+                self.ggvs[mass] = circuit.make_ggv(dict(self.veh, VEHICLE_MASS=mass), self.powertrain)
+            return self.ggvs[mass]
+
+
+def straight(length, dd):
+    """Return a straight track of stations about dd apart, for the acceleration run."""
+    n = int(round(length / dd))
+    step = length / n
+    return {'dd': step,
+            'x': np.zeros(n),
+            'y': -step * np.arange(n),
+            'len': np.full(n, step),
+            'dist': step * np.arange(1, n + 1),
+            'radius': np.full(n, np.inf)}
+
+
+def load_tracks(filenames, dd, width=None, tol=None):
+    """Discretize each distinct track file once, optimising its racing line if width is given."""
+    tracks = {}
+    for filename in filenames:
+        if filename not in tracks:
+            track = circuit.load_track(filename, dd, tol=tol)
+            tracks[filename] = track if width is None else racingline.optimise(track, width)
+    return tracks
+
+
+def accel(veh, env, dd):
+    """Return the time of a standing start over ACCEL_LENGTH."""
+    s = circuit.simulate(straight(ACCEL_LENGTH, dd), veh, ('t',), None, env.powertrain, env())
+    return float(s['t'][-1])
+
+
+def skidpad(veh, margin=racingline.MARGIN):
+    """Return the time of one lap of the skidpad, driven at the corner speed margin outside the inner circle."""
+    radius = SKIDPAD_DIAMETER / 2 + margin
+    v = circuit.corner_speeds(np.array([radius]), veh)[0]
+    return float(2 * np.pi * radius / v)
+
+
+def autocross(veh, env, track):
+    """Return the time of one lap of track from a standing start."""
+    s = circuit.simulate(track, veh, ('t',), None, env.powertrain, env())
+    return float(s['t'][-1])
+
+
+def endurance(veh, env, track, fuel=stint.FUEL):
+    """Return the time of an endurance stint around track, see stint.simulate()."""
+    return float(stint.simulate(track, veh, fuel=fuel, powertrain=env.powertrain, make_ggv=env)['t'].sum())
+
+
+def score(veh=circuit.VEHICLE, autocross_track=None, endurance_track=None, dd=0.05, width=None, tol=None,
+          best=BEST, events=EVENTS, pool=None):
+    """Run the events for one vehicle and return the time and points of each, and the total points.
+
+    Track files are as for pointmass_circuit.load_track(), and the endurance
+    runs on the autocross track unless given its own. Given a track width,
+    both are driven on the racing line, see racingline.py. The events run
+    concurrently on pool, or on a pool of their own.
+    """
+    endurance_track = endurance_track or autocross_track
+    files = [f for e, f in (('autocross', autocross_track), ('endurance', endurance_track)) if e in events]
+    tracks = load_tracks(files, dd, width, tol)
+    env = Envelopes(veh)
+    runs = {'accel': lambda: accel(veh, env, dd),
+            'skidpad': lambda: skidpad(veh),
+            'autocross': lambda: autocross(veh, env, tracks[autocross_track]),
+            'endurance': lambda: endurance(veh, env, tracks[endurance_track])}
+
+    with ThreadPoolExecutor(len(events)) if pool is None else nullcontext(pool) as pool:
+        futures = {e: pool.submit(runs[e]) for e in events}
+        times = {e: f.result() for e, f in futures.items()}
+    res = {e: {'time': times[e], 'points': points(e, times[e], best)} for e in events}
+    res['total'] = sum(r['points'] for r in res.values())
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    req = parser.add_argument_group('required named arguments')
+    req.add_argument('-a', '--autocross', required=True, help='A spline (.npy) or sectioned (.npz) autocross track output by dxf_to_tck.py. ')
+    parser.add_argument('-e', '--endurance', default=None, help='The endurance track, by default the autocross one. ')
+    parser.add_argument('-d', '--delta', type=float, default=0.05, help='The station spacing to use for simulation. ')
+    parser.add_argument('-t', '--tol', type=float, default=None, help='Space stations adaptively, see pointmass_circuit.py. ')
+    parser.add_argument('-w', '--width', type=float, default=None, help='Drive the autocross and endurance on the racing line within a track this wide. ')
+    parser.add_argument('--best', default='', metavar='EVENT=T,...',
+                        help='The best time of each event to score against, by default %s. ' % ','.join('%s=%g' % i for i in BEST.items()))
+    parser.add_argument('-o', '--output', default=None, help='A .json file to write the times and points to. ')
+    args = parser.parse_args()
+
+    best = dict(BEST)
+    for spec in filter(None, args.best.split(',')):
+        event, t = spec.split('=')
+        if event not in BEST:
+            parser.error("unknown event '%s'" % event)
+        best[event] = float(t)
+
+    res = score(autocross_track=args.autocross, endurance_track=args.endurance, dd=args.delta, width=args.width,
+                tol=args.tol, best=best)
+    for event in EVENTS:
+        print("%-10s %10.3f s %7.1f points" % (event, res[event]['time'], res[event]['points']))
+    print("Total = %s points" % str(round(res['total'], 1)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent=2)
@@ -4,9 +4,9 @@ import argparse
 import ezdxf
 from math import sin, cos, tan, atan, radians, inf, pi, atan2
 import numpy as np
-from matplotlib import pyplot as plt
 import warnings
-from scipy import interpolate
+from scipy import interpolate, spatial
+import piecewise
 
 
 def dist(p1, p2):
@@ -15,57 +15,49 @@ def dist(p1, p2):
 
 
 def endpoints(e):
-    """Return endpoints of a section."""
+    """Return the ways a section can be traversed as (start, end, direction)."""
     if e.dxftype() == 'LINE':
-        #        out.write("straight,%f\n" %
-        #                  dist((e.dxf.start[0], e.dxf.start[1]), (e.dxf.end[0], e.dxf.end[1])))
         p1 = (e.dxf.start[0], e.dxf.start[1])
         p2 = (e.dxf.end[0], e.dxf.end[1])
-        return ((p1, p2, 0),)
+        return ((p1, p2, 0), (p2, p1, 0))
     elif e.dxftype() == 'ARC':
-        #        out.write("turn,%f,%f\n" %
-        #                  (e.dxf.radius, (e.dxf.end_angle - e.dxf.start_angle)))
         c = (e.dxf.center[0], e.dxf.center[1])
         p1 = (c[0] + e.dxf.radius * cos(radians(e.dxf.start_angle)),
               c[1] + e.dxf.radius * sin(radians(e.dxf.start_angle)))
         p2 = (c[0] + e.dxf.radius * cos(radians(e.dxf.end_angle)),
               c[1] + e.dxf.radius * sin(radians(e.dxf.end_angle)))
-        q1 = (c[0] + e.dxf.radius * cos(radians(e.dxf.start_angle)),
-              c[1] + e.dxf.radius * sin(radians(e.dxf.start_angle)))
-        q2 = (c[0] + e.dxf.radius * cos(radians(e.dxf.end_angle)),
-              c[1] + e.dxf.radius * sin(radians(e.dxf.end_angle)))
-        return ((p1, p2, -1), (q2, q1, 1))
-
+        return ((p1, p2, -1), (p2, p1, 1))
 
-if __name__ == "__main__":
-    """Store the spline representation of a DXF in a numpy file."""
-    parser = argparse.ArgumentParser()
-    parser.add_argument('filename', help='A DXF file consisting of only LINEs and ARCs. ')
-    parser.add_argument('-d', '--delta', type=float, default=.001, help='The distance between points to be fed into the interpolation. ')
-    parser.add_argument('-c', '--closed', action='store_true', help='Specify that the track is closed. ')
-    args = parser.parse_args()
 
-    if args.filename[-4:] != ".dxf":
-        print("File must end in '.dxf'")
-        exit()
+def chain(modelspace):
+    """Order LINEs and ARCs into a connected path, starting from the first LINE.
 
-    dwg = ezdxf.readfile(args.filename)
-    modelspace = [x for x in dwg.modelspace() if x.dxftype() == "LINE" or x.dxftype() == "ARC"]
+    Every way of traversing every section is indexed by its start point in a
+    KD-tree, so each step is a nearest neighbour query rather than a scan of
+    all the remaining sections.
+    """
     s = [x for x in modelspace if x.dxftype() == 'LINE'][0]
-    modelspace.remove(s)
     sections = [{"type": s.dxftype(), "start": s.dxf.start, "end": s.dxf.end}]
-    del s
-    while modelspace:
-        td = inf
-        tf = None
-        tq = None
-        for f in modelspace:
-            for q1, q2, q3 in endpoints(f):
-                d = dist(q1, sections[-1]['end'])
-                if d < td:
-                    td = d
-                    tf = f
-                    tq = (q1, q2, q3)
+
+    ways = [(f, q) for f in modelspace if f is not s for q in endpoints(f)]
+    if not ways:
+        return sections
+    tree = spatial.cKDTree([q[0] for f, q in ways])
+    used = set()
+
+    for _ in range(len(modelspace) - 1):
+        # look at more and more neighbours until one belongs to an unused section
+        k = 8
+        while True:
+            end = sections[-1]['end']
+            _, idx = tree.query((end[0], end[1]), k=min(k, len(ways)))
+            found = [j for j in np.atleast_1d(idx) if id(ways[j][0]) not in used]
+            if found or k >= len(ways):
+                break
+            k *= 4
+        tf, tq = ways[found[0]]
+        used.add(id(tf))
+
         if tf.dxftype() == 'LINE':
             sections.append({"type": tf.dxftype(), "start": tq[0], "end": tq[1]})
         elif tf.dxftype() == 'ARC':
@@ -75,8 +67,17 @@ if __name__ == "__main__":
             if ang > 180:
                 ang -= 360
             sections.append({"type": tf.dxftype(), "start": tq[0], "end": tq[1], "radius": tf.dxf.radius, "angle": ang})
-        modelspace.remove(tf)
+    return sections
 
+
+def read(filename):
+    """Return the LINEs and ARCs in the modelspace of a DXF file."""
+    dwg = ezdxf.readfile(filename)
+    return [x for x in dwg.modelspace() if x.dxftype() == "LINE" or x.dxftype() == "ARC"]
+
+
+def track_list(sections):
+    """Convert chained DXF sections into the straights and turns taken by track_points()."""
     tracklist = []
     for sec in sections:
         if sec['type'] == 'LINE':
@@ -88,99 +89,141 @@ if __name__ == "__main__":
             tracklist.append({'type': 'turn',
                               'radius': sec['radius'],
                               'angle': sec['angle']})
+    return tracklist
+
+
+def fit(x, y, lens, rads):
+    """Fit a periodic spline through the track points, returning it in the layout saved to .npy."""
+    # fit splines to x=f(u) and y=g(u), treating both as periodic. also note that s=0
+    # is needed in order to force the spline fit to pass through all the input points.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        tck, u = interpolate.splprep([x, y], u=lens, s=0, per=True)
+    tck.append(lens[-1])
+    tck.append(rads)
+    return tck
+
 
-    points = [tracklist[0]['start']]
-    lens = [0]
+def track_points(tracklist, delta, closed):
+    """Generate points about delta apart along a list of track sections.
+
+    Returns the point coordinates, the cumulative distance to each point and
+    a list of (end distance, radius) pairs for the sections.
+    """
+    xs = [np.array([tracklist[0]['start'][0]])]
+    ys = [np.array([tracklist[0]['start'][1]])]
+    lens = [np.zeros(1)]
     angle = -pi / 2
     rads = []
     totdist = 0
     # generate points for each track element
     for sec in tracklist:
+        p1 = (xs[-1][-1], ys[-1][-1])
         # for straights, use linear interpolation between endpoints
         if sec['type'] == "straight":
             totdist += sec['length']
             rads.append((totdist, inf))
-            numdiv = round(sec['length'] / args.delta)
+            numdiv = max(1, round(sec['length'] / delta))
             dlen = sec['length'] / numdiv
-            for i in range(numdiv):
-                lens.append(dlen)
-                p1 = points[-1]
-                dx = cos(angle) * dlen
-                dy = sin(angle) * dlen
-                points.append((p1[0] + dx, p1[1] + dy))
+            steps = dlen * np.arange(1, numdiv + 1)
+            xs.append(p1[0] + cos(angle) * steps)
+            ys.append(p1[1] + sin(angle) * steps)
+            lens.append(np.full(numdiv, dlen))
         # for turns, calculate points along an arc starting at the current point
         elif sec['type'] == "turn":
             totdist += abs(sec['radius'] * radians(sec['angle']))
             rads.append((totdist, sec['radius']))
-            numdiv = int(round(sec['radius'] * abs(radians(sec['angle'])) / args.delta))
+            numdiv = max(1, int(round(sec['radius'] * abs(radians(sec['angle'])) / delta)))
             dangle = radians(sec['angle']) / numdiv
             try:
                 cangle = atan(-1 / tan(angle))
             except ZeroDivisionError:
                 cangle = atan(inf)
-            p1 = points[-1]
             sign_corr = (1 if sin(cangle) * cos(angle) >=
                          0 else -1) * (1 if dangle >= 0 else -1)
             cx = p1[0] + sign_corr * cos(cangle) * sec['radius']
             cy = p1[1] + sign_corr * sin(cangle) * sec['radius']
-            for i in range(numdiv):
-                lens.append(abs(sec['radius'] * dangle))
-                cangle += dangle
-                angle = (angle + dangle) % (2 * pi)
-                dx = sign_corr * cos(cangle) * sec['radius']
-                dy = sign_corr * sin(cangle) * sec['radius']
-                points.append((cx - dx, cy - dy))
-
-    if args.closed:
-        dist = ((points[-1][0] - points[0][0])**2 +
-                (points[-1][1] - points[0][1])**2)**.5
-        totdist += dist
+            cangles = cangle + dangle * np.arange(1, numdiv + 1)
+            xs.append(cx - sign_corr * np.cos(cangles) * sec['radius'])
+            ys.append(cy - sign_corr * np.sin(cangles) * sec['radius'])
+            lens.append(np.full(numdiv, abs(sec['radius'] * dangle)))
+            angle = (angle + numdiv * dangle) % (2 * pi)
+
+    if closed:
+        start = (xs[0][0], ys[0][0])
+        end = (xs[-1][-1], ys[-1][-1])
+        gap = dist(start, end)
+        totdist += gap
         rads.append((totdist, inf))
-        numdiv = round(dist / args.delta)
+        numdiv = round(gap / delta)
         if numdiv != 0:
-            dlen = dist / numdiv
-            angle = atan2(points[0][1] - points[-1][1],
-                          points[0][0] - points[-1][0])
-            for i in range(numdiv - 1):
-                p1 = points[-1]
-                dx = cos(angle) * dlen
-                dy = sin(angle) * dlen
-                points.append((p1[0] + dx, p1[1] + dy))
-                lens.append(dlen)
+            dlen = gap / numdiv
+            angle = atan2(start[1] - end[1], start[0] - end[0])
+            steps = dlen * np.arange(1, numdiv)
+            xs.append(end[0] + cos(angle) * steps)
+            ys.append(end[1] + sin(angle) * steps)
+            lens.append(np.full(numdiv - 1, dlen))
 
-    x, y = zip(*points)
-    lens = np.cumsum(lens)
+    return np.concatenate(xs), np.concatenate(ys), np.cumsum(np.concatenate(lens)), rads
 
-    print("Total length: %f m" % lens[-1])
 
-    x = np.array(x)
-    y = np.array(y)
+if __name__ == "__main__":
+    """Store the spline representation of a DXF in a numpy file."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', help='A DXF file consisting of only LINEs and ARCs. ')
+    parser.add_argument('-d', '--delta', type=float, default=.001, help='The distance between points to be fed into the interpolation. ')
+    parser.add_argument('-c', '--closed', action='store_true', help='Specify that the track is closed. ')
+    parser.add_argument('-s', '--sections', action='store_true', help='Store exact section lengths and curvatures in a .npz file instead of fitting a spline. ')
+    parser.add_argument('-t', '--transition', type=float, default=0, help='The length of clothoid transitions between sections, with --sections. ')
+    args = parser.parse_args()
 
-    # fit splines to x=f(u) and y=g(u), treating both as periodic. also note that s=0
-    # is needed in order to force the spline fit to pass through all the input points.
-    warnings.simplefilter("ignore")
-    tck, u = interpolate.splprep([x, y], u=lens, s=0, per=True)
-    warnings.simplefilter("default")
+    if args.filename[-4:] != ".dxf":
+        print("File must end in '.dxf'")
+        exit()
 
-    tck.append(lens[-1])
-    tck.append(rads)
-    np.save(args.filename[:-4], tck)
-
-    tck2 = np.load(args.filename[:-3] + 'npy')
-    # evaluate the spline fits for 1000 evenly spaced distance values
-    ui = np.linspace(0, tck2[3], 500)
-    xi, yi = interpolate.splev(ui, tck2[:3])
-
-    radcols = []
-    for u in ui:
-        r = [r[1] for r in rads if round(u, 5) <= round(r[0], 5)][0]
-        radcols.append(min(r, 50))
-    # plot the result
-    # plt.plot(ui, radcols)
-    plt.plot(x, y, label='poly')
-    plt.set_cmap('plasma')
-    plt.scatter(xi, yi, s=20, c=radcols, label='interp')
-    plt.axis('equal')
-    plt.colorbar()
-    plt.legend(loc='best')
-    plt.show()
+    from matplotlib import pyplot as plt
+
+    sections = chain(read(args.filename))
+
+    if args.sections:
+        trk = piecewise.from_sections(sections, args.closed, args.transition)
+        piecewise.save(args.filename[:-4] + '.npz', trk)
+        print("Total length: %f m" % trk['total'])
+
+        # plot the result
+        ui = np.linspace(0, trk['total'], 500)
+        xi, yi = piecewise.positions(trk, ui)
+        with np.errstate(divide='ignore'):
+            radcols = np.minimum(np.abs(1 / piecewise.curvature(trk, ui)), 50)
+        plt.set_cmap('plasma')
+        plt.scatter(xi, yi, s=20, c=radcols, label='sections')
+        plt.axis('equal')
+        plt.colorbar()
+        plt.legend(loc='best')
+        plt.show()
+    else:
+        x, y, lens, rads = track_points(track_list(sections), args.delta, args.closed)
+
+        print("Total length: %f m" % lens[-1])
+
+        tck = fit(x, y, lens, rads)
+        np.save(args.filename[:-4], np.array(tck, dtype=object))
+
+        tck2 = np.load(args.filename[:-3] + 'npy', allow_pickle=True)
+        # evaluate the spline fits for 1000 evenly spaced distance values
+        ui = np.linspace(0, tck2[3], 500)
+        xi, yi = interpolate.splev(ui, list(tck2[:3]))
+
+        radcols = []
+        for u in ui:
+            r = [r[1] for r in rads if round(u, 5) <= round(r[0], 5)][0]
+            radcols.append(min(r, 50))
+        # plot the result
+        # plt.plot(ui, radcols)
+        plt.plot(x, y, label='poly')
+        plt.set_cmap('plasma')
+        plt.scatter(xi, yi, s=20, c=radcols, label='interp')
+        plt.axis('equal')
+        plt.colorbar()
+        plt.legend(loc='best')
+        plt.show()
@@ -0,0 +1,246 @@
+"""Sequential velocity sweeps for the circuit solver.
+
+The forward and braking sweeps are the only parts of a lap that cannot be
+vectorized, since each station depends on the one before it. They are
+written against plain floats and arrays so that Numba can compile them when
+it is installed; otherwise the same functions run as ordinary Python. Set
+NUMBA_DISABLE_JIT=1 to force the Python path with Numba installed. Compiled
+kernels release the GIL, so separate stretches of a lap can be swept on
+several threads at once.
+
+The batch sweeps advance many vehicle setups at once, one station at a
+time, with every setup in a column of C ordered (station, setup) arrays.
+Compiled, they loop over the setups of each station; otherwise NumPy works
+across them. Either way they do the same arithmetic as the single setup
+sweeps and match them exactly.
+"""
+
+from math import sqrt
+import numpy as np
+
+try:
+    from numba import config, njit
+except ImportError:
+    njit = None
+
+# whether the kernels run compiled, which NUMBA_DISABLE_JIT=1 turns off
+COMPILED = njit is not None and not config.DISABLE_JIT
+
+
+def jit(func):
+    """Compile a kernel if Numba is available."""
+    if njit is None:
+        return func
+    return njit(cache=True, nogil=True)(func)
+
+
+@jit
+def lookup(table, step, x):
+    """Linearly interpolate a table sampled every step from zero, clamping at the end."""
+    u = x / step
+    k = int(u)
+    if k >= len(table) - 1:
+        return table[len(table) - 1]
+    return table[k] + (u - k) * (table[k + 1] - table[k])
+
+
+@jit
+def friction_limit(v, absr, mass, dv, grip_lat, grip_long):
+    """Return the longitudinal tire force left over after cornering at speed v.
+
+    grip_lat and grip_long tabulate the peak lateral force of the car and
+    the peak longitudinal force of its driven axle against speed, every dv.
+    """
+    f_lat_tire = lookup(grip_lat, dv, v)
+    f_lat = min(f_lat_tire, mass * v * v / absr)
+    share = f_lat / f_lat_tire
+    return sqrt(max(1 - share * share, 0.)) * lookup(grip_long, dv, v)
+
+
+@jit
+def forward_sweep(vel, acc, capped, absr, v_corner, ds, mass, k_drag, dv, grip_lat, grip_long,
+                  drive, v_top, v0):
+    """Integrate the acceleration limited velocity profile from speed v0, in place.
+
+    drive tabulates the engine force at the tires on the same speed grid as
+    the grip. Step i is ds[i] long and ends at station i, so stations need
+    not be evenly spaced.
+    """
+    v = v0
+    for i in range(len(vel)):
+        f_eng = lookup(drive, dv, v)
+        f_fric = friction_limit(v, absr[i], mass, dv, grip_lat, grip_long)
+        a = (min(f_fric, f_eng) - k_drag * v) / mass
+
+        v_next = sqrt(max(v * v + 2 * a * ds[i], 0.))
+        if v_next > v_corner[i]:
+            v_next = v_corner[i]
+            a = 0.
+        if v_next > v_top + .00001:
+            v_next = v_top
+            a = 0.
+            capped[i] = True
+
+        vel[i] = v_next
+        acc[i] = a
+        v = v_next
+
+
+@jit
+def backward_sweep(vel, acc, braking, absr, ds, mass, k_drag, dv, grip_lat, grip_long):
+    """Limit the velocity profile by braking into every slower station, in place."""
+    for i in range(len(vel) - 2, -1, -1):
+        v = vel[i + 1]
+        if vel[i] <= v:
+            continue
+        # brake over step i + 1, which runs from station i to station i + 1
+        f_fric = friction_limit(v, absr[i + 1], mass, dv, grip_lat, grip_long)
+        a = (-f_fric - k_drag * v) / mass
+
+        vel[i] = min(vel[i], sqrt(v * v - 2 * a * ds[i + 1]))
+        acc[i] = a
+        braking[i] = True
+
+
+@jit
+def lookup_row(table, j, step, x):
+    """Interpolate column j of a table like lookup()."""
+    u = x / step
+    k = int(u)
+    last = table.shape[0] - 1
+    if k >= last:
+        return table[last, j]
+    return table[k, j] + (u - k) * (table[k + 1, j] - table[k, j])
+
+
+@jit
+def friction_limit_row(v, absr, mass, dv, grip_lat, grip_long, j):
+    """Return friction_limit() for setup j of a batch, whose grip tables are column j of grip_lat and grip_long."""
+    f_lat_tire = lookup_row(grip_lat, j, dv, v)
+    f_lat = min(f_lat_tire, mass * v * v / absr)
+    share = f_lat / f_lat_tire
+    return sqrt(max(1 - share * share, 0.)) * lookup_row(grip_long, j, dv, v)
+
+
+@jit
+def forward_sweep_rows(vel, acc, capped, absr, v_corner, ds, mass, k_drag, dv, grip_lat, grip_long,
+                       drive, v_top, v0):
+    """Run forward_sweep() for a batch of setups, looping over the setups at each station."""
+    v = v0.copy()
+    for i in range(vel.shape[0]):
+        for j in range(vel.shape[1]):
+            f_eng = lookup_row(drive, j, dv, v[j])
+            f_fric = friction_limit_row(v[j], absr[i], mass[j], dv, grip_lat, grip_long, j)
+            a = (min(f_fric, f_eng) - k_drag[j] * v[j]) / mass[j]
+
+            v_next = sqrt(max(v[j] * v[j] + 2 * a * ds[i], 0.))
+            if v_next > v_corner[i, j]:
+                v_next = v_corner[i, j]
+                a = 0.
+            if v_next > v_top[j] + .00001:
+                v_next = v_top[j]
+                a = 0.
+                capped[i, j] = True
+
+            vel[i, j] = v_next
+            acc[i, j] = a
+            v[j] = v_next
+
+
+@jit
+def backward_sweep_rows(vel, acc, braking, absr, ds, mass, k_drag, dv, grip_lat, grip_long):
+    """Run backward_sweep() for a batch of setups, looping over the setups at each station."""
+    for i in range(vel.shape[0] - 2, -1, -1):
+        for j in range(vel.shape[1]):
+            v = vel[i + 1, j]
+            if vel[i, j] <= v:
+                continue
+            f_fric = friction_limit_row(v, absr[i + 1], mass[j], dv, grip_lat, grip_long, j)
+            a = (-f_fric - k_drag[j] * v) / mass[j]
+
+            vel[i, j] = min(vel[i, j], sqrt(v * v - 2 * a * ds[i + 1]))
+            acc[i, j] = a
+            braking[i, j] = True
+
+
+def lookup_batch(table, step, x):
+    """Interpolate each column of a table at the matching entry of x, like lookup().
+
+    A one dimensional table is shared by every entry of x.
+    """
+    u = x / step
+    k = np.minimum(u.astype(np.int64), len(table) - 1)
+    k1 = np.minimum(k + 1, len(table) - 1)
+    if table.ndim == 1:
+        lo, hi = table[k], table[k1]
+    else:
+        cols = np.arange(table.shape[1])
+        lo, hi = table[k, cols], table[k1, cols]
+    return np.where(k >= len(table) - 1, lo, lo + (u - k) * (hi - lo))
+
+
+def friction_limit_batch(v, absr, mass, dv, grip_lat, grip_long):
+    """Return the longitudinal tire force left over after cornering for every setup, like friction_limit()."""
+    f_lat_tire = lookup_batch(grip_lat, dv, v)
+    f_lat = np.minimum(f_lat_tire, mass * v * v / absr)
+    share = f_lat / f_lat_tire
+    return np.sqrt(np.maximum(1 - share * share, 0.)) * lookup_batch(grip_long, dv, v)
+
+
+def forward_sweep_numpy(vel, acc, capped, absr, v_corner, ds, mass, k_drag, dv, grip_lat, grip_long,
+                        drive, v_top, v0):
+    """Run forward_sweep() for a batch of setups, with NumPy working across the setups at each station."""
+    v = np.array(v0, dtype=float)
+    for i in range(len(vel)):
+        f_eng = lookup_batch(drive, dv, v)
+        f_fric = friction_limit_batch(v, absr[i], mass, dv, grip_lat, grip_long)
+        a = (np.minimum(f_fric, f_eng) - k_drag * v) / mass
+
+        v_next = np.sqrt(np.maximum(v * v + 2 * a * ds[i], 0.))
+        corner = v_next > v_corner[i]
+        v_next[corner] = v_corner[i][corner]
+        a[corner] = 0.
+        top = v_next > v_top + .00001
+        v_next[top] = v_top[top]
+        a[top] = 0.
+        capped[i] = top
+
+        vel[i] = v_next
+        acc[i] = a
+        v = v_next
+
+
+def backward_sweep_numpy(vel, acc, braking, absr, ds, mass, k_drag, dv, grip_lat, grip_long):
+    """Run backward_sweep() for a batch of setups, with NumPy working across the setups at each station."""
+    for i in range(len(vel) - 2, -1, -1):
+        v = vel[i + 1]
+        brake = vel[i] > v
+        if not brake.any():
+            continue
+        f_fric = friction_limit_batch(v, absr[i + 1], mass, dv, grip_lat, grip_long)
+        a = (-f_fric - k_drag * v) / mass
+
+        with np.errstate(invalid='ignore'):
+            v_brake = np.sqrt(v * v - 2 * a * ds[i + 1])
+        vel[i] = np.where(brake, np.minimum(vel[i], v_brake), vel[i])
+        acc[i] = np.where(brake, a, acc[i])
+        braking[i] |= brake
+
+
+def forward_sweep_batch(vel, acc, capped, absr, v_corner, ds, mass, k_drag, dv, grip_lat, grip_long,
+                        drive, v_top, v0):
+    """Run forward_sweep() for a batch of setups, in place.
+
+    vel, acc, capped and v_corner are (station, setup) arrays, mass, k_drag,
+    v_top and v0 hold one value per setup, and the grip and drive tables are
+    (speed, setup) arrays. The setups of a batch are at similar speeds at any
+    one station, so the table entries they look up lie close together.
+    """
+    sweep = forward_sweep_rows if COMPILED else forward_sweep_numpy
+    sweep(vel, acc, capped, absr, v_corner, ds, mass, k_drag, dv, grip_lat, grip_long, drive, v_top, v0)
+
+
+def backward_sweep_batch(vel, acc, braking, absr, ds, mass, k_drag, dv, grip_lat, grip_long):
+    """Run backward_sweep() for a batch of setups, in place, see forward_sweep_batch()."""
+    sweep = backward_sweep_rows if COMPILED else backward_sweep_numpy
+    sweep(vel, acc, braking, absr, ds, mass, k_drag, dv, grip_lat, grip_long)
@@ -0,0 +1,249 @@
+"""Library interface to the circuit simulator.
+
+Importing this module does not touch matplotlib or parse any arguments, so
+an optimiser or a notebook can build a Vehicle and a Track once and then run
+thousands of laps in one process:
+
+    import lapsim
+    track = lapsim.Track.from_file('endurancemichigan2018.npz', 0.01)
+    sim = lapsim.LapSimulator(lapsim.Vehicle.default().replace(Cl=1.2))
+    print(sim.lap_time(track))
+"""
+
+from dataclasses import dataclass, fields, replace
+import numpy as np
+import kernels
+import pointmass_circuit as circuit
+import tires
+
+
+@dataclass(frozen=True, slots=True)
+class Vehicle:
+    """Vehicle parameters, with the same names as pointmass_circuit.VEHICLE.
+
+    Vehicles are immutable and hashable, so they can key caches of results.
+    They can also be indexed like the VEHICLE dict wherever the circuit
+    functions expect one.
+    """
+
+    VEHICLE_MASS: float
+    Cd: float
+    Cl: float
+    A: float
+    tire_radius: float
+    CG_long: float
+    CP_long: float
+    CG_vert: float
+    wheelbase: float
+    trackwidth_front: float
+    trackwidth_rear: float
+    upshift_RPM: float
+    final_drive: float
+    gear_ratios: tuple
+    torque_curve: tuple
+
+    @classmethod
+    def from_dict(cls, params):
+        """Build a vehicle from a dict shaped like pointmass_circuit.VEHICLE."""
+        params = dict(params)
+        params['gear_ratios'] = tuple(params['gear_ratios'])
+        params['torque_curve'] = tuple(tuple(p) for p in params['torque_curve'])
+        return cls(**{f.name: params[f.name] for f in fields(cls)})
+
+    @classmethod
+    def default(cls):
+        """Return the vehicle described by pointmass_circuit.VEHICLE."""
+        return cls.from_dict(circuit.VEHICLE)
+
+    def replace(self, **changes):
+        """Return a copy with some parameters changed."""
+        if 'gear_ratios' in changes or 'torque_curve' in changes:
+            return Vehicle.from_dict(dict(self.as_dict(), **changes))
+        return replace(self, **changes)
+
+    def as_dict(self):
+        """Return the parameters as a plain dict."""
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+@dataclass(slots=True)
+class Track:
+    """A discretized track, see pointmass_circuit.discretize()."""
+
+    x: np.ndarray
+    y: np.ndarray
+    radius: np.ndarray
+    len: np.ndarray
+    dist: np.ndarray
+    dd: float
+
+    @classmethod
+    def from_file(cls, filename, dd=0.01, smooth=None, tol=None, dd_max=circuit.DD_MAX, cache=True):
+        """Discretize a track file written by dxf_to_tck.py, going through the track cache."""
+        track = circuit.load_track(filename, dd, smooth, tol, dd_max, cache)
+        return cls(**{f.name: track[f.name] for f in fields(cls)})
+
+    def __len__(self):
+        return len(self.len)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+
+class LapSimulator:
+    """Simulate laps of one vehicle.
+
+    The powertrain tables and g-g-speed envelope are built once for the
+    vehicle and reused by every lap. Only the channels asked for are kept, by default the ones
+    summary() needs. Given a thread pool and its number of threads, each lap
+    is swept in apex to apex segments on it. The tire is a parameter dict
+    like tires.TIRE.
+    """
+
+    __slots__ = ('vehicle', 'channels', 'powertrain', 'ggv', 'pool', 'threads', 'tire')
+
+    def __init__(self, vehicle=None, channels=circuit.SUMMARY, pool=None, threads=None, tire=tires.TIRE):
+        self.vehicle = Vehicle.default() if vehicle is None else vehicle
+        self.channels = tuple(channels)
+        self.pool = pool
+        self.threads = threads
+        self.tire = tire
+        self.powertrain = circuit.make_powertrain(self.vehicle)
+        self.ggv = circuit.make_ggv(self.vehicle, self.powertrain, tire)
+
+    def simulate(self, track, out=None):
+        """Return the per-station telemetry of a lap of track."""
+        return circuit.simulate(track, self.vehicle, self.channels, out, self.powertrain, self.ggv, self.pool,
+                                self.threads, tire=self.tire)
+
+    def summary(self, track):
+        """Return the headline numbers of a lap of track."""
+        return circuit.summary(self.simulate(track))
+
+    def lap_time(self, track):
+        """Return the lap time of track in seconds."""
+        return float(self.simulate(track)['t'][-1])
+
+    def solve(self, track):
+        """Return a Lap of track that can be re-solved locally after the track changes."""
+        return Lap(self, track)
+
+
+class Lap:
+    """A solved lap that keeps the structure of its velocity profile.
+
+    Besides the final profile, a Lap keeps the acceleration limited forward
+    profile it was braked down from. After the radius of a few stations
+    changes, set_radius() re-runs the forward sweep from the first changed
+    station only until it falls back onto the old profile, which happens at
+    the next corner that caps both, and then re-runs the braking sweep
+    backwards from there only until it meets the old braking zones. The
+    result is identical to solving the changed track from scratch.
+
+    A vehicle change moves every station, so set_vehicle() solves the whole
+    lap again.
+    """
+
+    __slots__ = ('sim', 'radius', 'absr', 'len', 'v_corner', 'fwd', 'fwd_acc', 'capped',
+                 'vel', 'acc', 'braking', 'dt', 'chunk')
+
+    def __init__(self, sim, track, chunk=64):
+        self.sim = sim
+        self.radius = np.array(track['radius'], dtype=float)
+        self.absr = np.abs(self.radius)
+        self.len = np.asarray(track['len'], dtype=float)
+        self.chunk = chunk
+        n = len(self.len)
+        self.fwd = np.zeros(n)
+        self.fwd_acc = np.zeros(n)
+        self.capped = np.zeros(n, dtype=bool)
+        self.vel = np.zeros(n)
+        self.acc = np.zeros(n)
+        self.braking = np.zeros(n, dtype=bool)
+        self.dt = np.zeros(n)
+        self.set_vehicle(sim.vehicle)
+
+    def set_vehicle(self, vehicle):
+        """Change the vehicle and solve the whole lap again."""
+        if vehicle != self.sim.vehicle:
+            self.sim = LapSimulator(vehicle, self.sim.channels, self.sim.pool, self.sim.threads, self.sim.tire)
+        self.v_corner = circuit.corner_speeds(self.radius, vehicle, tire=self.sim.tire)
+        n = len(self.len)
+        self._forward(0, n, n)
+        self._backward(0, n)
+        return self.lap_time()
+
+    def set_radius(self, start, radius):
+        """Change the radius of the stations from start on and re-solve the affected part of the lap.
+
+        Returns the new lap time.
+        """
+        radius = np.asarray(radius, dtype=float)
+        stop = start + len(radius)
+        self.radius[start:stop] = radius
+        self.absr[start:stop] = np.abs(radius)
+        self.v_corner[start:stop] = circuit.corner_speeds(radius, self.sim.vehicle, tire=self.sim.tire)
+        end = self._forward(start, stop)
+        self._backward(start, end)
+        return self.lap_time()
+
+    def lap_time(self):
+        """Return the lap time in seconds."""
+        return float(self.dt.sum())
+
+    def _forward(self, start, stop, limit=None):
+        """Re-run the forward sweep from start until it rejoins the old profile after stop.
+
+        Returns the end of the stations that changed.
+        """
+        n = len(self.len)
+        ggv = self.sim.ggv
+        args = circuit.sweep_args(self.sim.vehicle, ggv)
+        lo, chunk = start, self.chunk
+        while lo < n:
+            hi = min(n, max(lo, stop) + chunk) if limit is None else limit
+            old = self.fwd[lo:hi].copy()
+            self.capped[lo:hi] = False
+            kernels.forward_sweep(self.fwd[lo:hi], self.fwd_acc[lo:hi], self.capped[lo:hi], self.absr[lo:hi],
+                                  self.v_corner[lo:hi], self.len[lo:hi], *args,
+                                  ggv['F_drive'], ggv['v_top'],
+                                  self.fwd[lo - 1] if lo > 0 else 0.)
+            # past the changed stations, a station that comes out the same fixes all the ones after it
+            first = max(lo, stop)
+            same = np.flatnonzero(self.fwd[first:hi] == old[first - lo:])
+            if len(same):
+                return first + same[0] + 1
+            lo, chunk = hi, 2 * chunk
+        return n
+
+    def _backward(self, start, end):
+        """Re-run the braking sweep down from end until it rejoins the old profile before start."""
+        n = len(self.len)
+        args = circuit.sweep_args(self.sim.vehicle, self.sim.ggv)
+        hi, lo, chunk = end, max(0, start - self.chunk), self.chunk
+        while True:
+            # the station at hi keeps its final speed and braking starts from there
+            top = min(hi + 1, n)
+            old = self.vel[lo:hi].copy()
+            self.vel[lo:hi] = self.fwd[lo:hi]
+            self.acc[lo:hi] = self.fwd_acc[lo:hi]
+            self.braking[lo:hi] = False
+            kernels.backward_sweep(self.vel[lo:top], self.acc[lo:top], self.braking[lo:top], self.absr[lo:top],
+                                   self.len[lo:top], *args)
+            # before the changed stations, a station that comes out the same fixes all the ones before it
+            below = min(start, hi)
+            same = np.flatnonzero(self.vel[lo:below] == old[:below - lo])
+            if len(same) or lo == 0:
+                break
+            hi, lo, chunk = lo, max(0, lo - 2 * chunk), 2 * chunk
+
+        low = lo + same[-1] if len(same) else 0
+        stop = min(end + 1, n)
+        v_prev = self.vel[low - 1:stop - 1] if low > 0 else np.concatenate(([0.], self.vel[:stop - 1]))
+        self.dt[low:stop] = circuit.step_time(v_prev, self.vel[low:stop], self.len[low:stop])
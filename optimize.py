@@ -0,0 +1,255 @@
+"""Optimize vehicle parameters for lap time, or competition points, on top of the circuit solver."""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+from scipy import optimize
+import competition
+import lapsim
+import pointmass_circuit as circuit
+import trackcache
+
+# per-worker state, set once by _init so the tracks are not resent with every evaluation
+_tracks = None
+_weights = None
+_base = None
+_names = None
+_kind = None
+_score_args = None
+
+
+def apply(vehicle, names, x):
+    """Return a copy of vehicle with the named parameters set to the values in x, see circuit.parameter()."""
+    return vehicle.replace(**circuit.parameter_changes(vehicle, {n: float(v) for n, v in zip(names, x)}))
+
+
+def current(vehicle, names):
+    """Return the values of the named parameters of vehicle."""
+    return np.array([circuit.parameter(vehicle, n) for n in names], dtype=float)
+
+
+def objective(vehicle, tracks, weights):
+    """Return the weighted sum of the lap times of vehicle around tracks."""
+    sim = lapsim.LapSimulator(vehicle, ('t',))
+    return sum(w * sim.lap_time(track) for track, w in zip(tracks, weights))
+
+
+def score_objective(vehicle, filenames, dd, tol=None):
+    """Return minus the competition points of vehicle, see competition.score().
+
+    The first track is the autocross and the second, if given, the endurance.
+    """
+    endurance = filenames[1] if len(filenames) > 1 else None
+    return -competition.score(vehicle.as_dict(), filenames[0], endurance, dd, tol=tol)['total']
+
+
+def _init(filenames, dd, tol, weights, base, names, kind='time'):
+    """Load the tracks and keep the problem definition in a worker process."""
+    global _tracks, _weights, _base, _names, _kind, _score_args
+    # competition.score() loads its own tracks
+    _tracks = [lapsim.Track.from_file(f, dd, tol=tol) for f in filenames] if kind == 'time' else None
+    _weights = weights
+    _base = base
+    _names = names
+    _kind = kind
+    _score_args = (filenames, dd, tol)
+
+
+def _evaluate(x):
+    """Evaluate one parameter set in a worker process."""
+    if _kind == 'score':
+        return score_objective(apply(_base, _names, x), *_score_args)
+    return objective(apply(_base, _names, x), _tracks, _weights)
+
+
+class Cache:
+    """Objective values of the parameter sets evaluated so far.
+
+    Parameter sets are compared after rounding to a number of decimals.
+    Given a path, the cache is loaded from and saved to a .npz file, which
+    lets a later run warm start from everything an earlier one evaluated.
+    A saved cache is only reused if it was made for the same parameter names
+    and the same problem, a string describing the tracks and base vehicle.
+    """
+
+    def __init__(self, names, path=None, problem='', decimals=10):
+        self.names = list(names)
+        self.path = path
+        self.problem = problem
+        self.decimals = decimals
+        self.values = {}
+        if path is not None and os.path.exists(path):
+            saved = np.load(path)
+            if list(saved['names']) == self.names and str(saved['problem']) == problem:
+                for x, f in zip(saved['x'], saved['f']):
+                    self.values[self.key(x)] = float(f)
+
+    def key(self, x):
+        """Return the dict key of a parameter set."""
+        return tuple(np.round(np.asarray(x, dtype=float), self.decimals).tolist())
+
+    def best(self):
+        """Return the best parameter set and its objective, or None if the cache is empty."""
+        if not self.values:
+            return None
+        x, f = min(self.values.items(), key=lambda item: item[1])
+        return np.array(x), f
+
+    def save(self):
+        """Write the cache to its file, if it has one."""
+        if self.path is None:
+            return
+        x = np.array(list(self.values), dtype=float).reshape(-1, len(self.names))
+        tmp = '%s.%d.tmp.npz' % (os.path.splitext(self.path)[0], os.getpid())
+        np.savez(tmp, names=self.names, problem=self.problem, x=x, f=np.array(list(self.values.values())))
+        os.replace(tmp, self.path)
+
+
+class Evaluator:
+    """Evaluate batches of parameter sets across a process pool, skipping cached ones.
+
+    The objective is the weighted lap time, or minus the competition points
+    with kind='score'.
+    """
+
+    def __init__(self, filenames, dd, names, base=None, weights=None, tol=None, cache=None, workers=None,
+                 kind='time'):
+        base = lapsim.Vehicle.default() if base is None else base
+        weights = [1.] * len(filenames) if weights is None else list(weights)
+        self.names = list(names)
+        self.cache = Cache(names) if cache is None else cache
+        self.evaluations = 0
+        self.hits = 0
+        # build the track cache once here so that every worker only maps it
+        for f in filenames:
+            lapsim.Track.from_file(f, dd, tol=tol)
+        self.pool = ProcessPoolExecutor(workers, initializer=_init,
+                                        initargs=(filenames, dd, tol, weights, base, self.names, kind))
+
+    def close(self):
+        """Shut down the worker processes and save the cache."""
+        self.pool.shutdown()
+        self.cache.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def evaluate(self, xs):
+        """Return the objective of every parameter set in xs, evaluating the new ones in parallel."""
+        keys = [self.cache.key(x) for x in xs]
+        todo = list(dict.fromkeys(k for k in keys if k not in self.cache.values))
+        for k, f in zip(todo, self.pool.map(_evaluate, todo)):
+            self.cache.values[k] = f
+        self.evaluations += len(todo)
+        self.hits += len(keys) - len(todo)
+        if todo:
+            self.cache.save()
+        return [self.cache.values[k] for k in keys]
+
+    def __call__(self, x):
+        return self.evaluate([x])[0]
+
+    def map(self, func, xs):
+        """Evaluate a population for differential_evolution, which passes its own wrapper of self as func."""
+        return self.evaluate(list(xs))
+
+    def gradient(self, x, bounds, rel_step=1e-3):
+        """Return the central difference gradient at x, with all 2n evaluations run at once."""
+        x = np.asarray(x, dtype=float)
+        low, high = np.array(bounds, dtype=float).T
+        h = rel_step * (high - low)
+        up = np.minimum(x + h, high)
+        down = np.maximum(x - h, low)
+        xs = []
+        for i in range(len(x)):
+            xs.append(np.where(np.arange(len(x)) == i, up, x))
+            xs.append(np.where(np.arange(len(x)) == i, down, x))
+        f = np.array(self.evaluate(xs)).reshape(-1, 2)
+        return (f[:, 0] - f[:, 1]) / (up - down)
+
+
+def differential_evolution(evaluator, bounds, maxiter=50, popsize=15, seed=None, x0=None, tol=1e-6):
+    """Minimize with differential evolution, evaluating each generation in parallel.
+
+    The default relative tolerance of scipy would stop as soon as the lap
+    times of a generation are within 1% of each other, which is most of the
+    range worth optimizing over, so it is much tighter here.
+    """
+    return optimize.differential_evolution(evaluator, bounds, maxiter=maxiter, popsize=popsize, seed=seed,
+                                           x0=x0, tol=tol, workers=evaluator.map, updating='deferred',
+                                           polish=False)
+
+
+def gradient_descent(evaluator, bounds, x0, maxiter=50, rel_step=1e-3):
+    """Minimize with L-BFGS-B from x0, using parallel finite difference gradients."""
+    return optimize.minimize(evaluator, x0, method='L-BFGS-B', bounds=bounds,
+                             jac=lambda x: evaluator.gradient(x, bounds, rel_step),
+                             options={'maxiter': maxiter})
+
+
+def parse_bounds(spec):
+    """Split a name=low,high option into a name and a (low, high) pair."""
+    name, values = spec.split('=')
+    low, high = (float(v) for v in values.split(','))
+    return name, (low, high)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    req = parser.add_argument_group('required named arguments')
+    req.add_argument('-f', '--filename', required=True, action='append',
+                     help='A track output by dxf_to_tck.py. Can be repeated to optimize the weighted sum of lap times. ')
+    req.add_argument('-p', '--param', required=True, action='append', metavar='NAME=LOW,HIGH',
+                     help='A vehicle parameter to optimize between two bounds, such as Cl or gear_ratios[0]. Can be repeated. ')
+    parser.add_argument('-w', '--weight', type=float, action='append', default=None, help='The weight of each track. ')
+    parser.add_argument('-o', '--objective', choices=('time', 'score'), default='time',
+                        help='Minimize lap time, or maximize the competition points with the first track as the '
+                             'autocross and the second, if given, as the endurance, see competition.py. ')
+    parser.add_argument('-m', '--method', choices=('de', 'gradient'), default='de',
+                        help='Differential evolution, or L-BFGS-B with finite difference gradients. ')
+    parser.add_argument('-d', '--delta', type=float, default=0.01, help='The station spacing to use for simulation. ')
+    parser.add_argument('-t', '--tol', type=float, default=None, help='Space stations adaptively, see pointmass_circuit.py. ')
+    parser.add_argument('-n', '--maxiter', type=int, default=50, help='The maximum number of generations or iterations. ')
+    parser.add_argument('--popsize', type=int, default=15, help='The population size multiplier for differential evolution. ')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='The seed for differential evolution. ')
+    parser.add_argument('-c', '--cache', default=None, help='A .npz file of evaluated setups to warm start from and add to. ')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='The number of worker processes. ')
+    args = parser.parse_args()
+
+    base = lapsim.Vehicle.default()
+    bounds = dict(map(parse_bounds, args.param))
+    names = list(bounds)
+    for name in names:
+        gear = circuit.GEAR.fullmatch(name)
+        if gear and int(gear.group(1)) >= len(base.gear_ratios) or not gear and name not in base.as_dict():
+            parser.error("unknown vehicle parameter '%s'" % name)
+    if args.weight is not None and len(args.weight) != len(args.filename):
+        parser.error("give one weight per track")
+    if args.objective == 'score' and (len(args.filename) > 2 or args.weight is not None):
+        parser.error("the score objective takes an autocross and an optional endurance track, without weights")
+
+    weights = [1.] * len(args.filename) if args.weight is None else args.weight
+    problem = repr(([trackcache.cache_key(f, args.delta, tol=args.tol) for f in args.filename], weights, base,
+                    args.objective))
+    cache = Cache(names, args.cache, problem)
+    warm = cache.best()
+    # the score objective is minus the points, printed as points
+    sign = -1 if args.objective == 'score' else 1
+    x0 = np.clip(current(base, names) if warm is None else warm[0], *np.array(list(bounds.values())).T)
+    if warm is not None:
+        print("Warm starting from %s = %s" % (dict(zip(names, warm[0].tolist())), round(sign * warm[1], 4)))
+
+    with Evaluator(args.filename, args.delta, names, base, weights, args.tol, cache, args.workers,
+                   args.objective) as ev:
+        print("Baseline = %s" % str(round(sign * ev(x0), 4)))
+        if args.method == "de":
+            res = differential_evolution(ev, list(bounds.values()), args.maxiter, args.popsize, args.seed, x0)
+        else:
+            res = gradient_descent(ev, list(bounds.values()), x0, args.maxiter)
+
+    print("%d evaluations, %d cached" % (ev.evaluations, ev.hits))
+    print("Best = %s with %s" % (str(round(sign * res.fun, 4)), dict(zip(names, res.x.tolist()))))
@@ -0,0 +1,143 @@
+"""Piecewise track representation with exact section curvature.
+
+A track is a list of sections, each with a length and a curvature that
+varies linearly from its start to its end. Straights and arcs have constant
+curvature and clothoid transitions ramp between them. Curvature is signed,
+positive for left turns. Tracks are stored as small .npz files, so there is
+no resampling or spline fit between the DXF and the simulator.
+"""
+
+from math import atan2, copysign, radians
+import numpy as np
+
+
+def from_sections(sections, closed=False, transition=0.):
+    """Build a track from the chained LINE and ARC sections of a DXF.
+
+    If transition is given, every change in curvature is replaced by a
+    clothoid of up to that length, taken equally from both neighbours.
+    """
+    length = []
+    k = []
+    for sec in sections:
+        if sec['type'] == 'LINE':
+            length.append(((sec['end'][0] - sec['start'][0])**2 + (sec['end'][1] - sec['start'][1])**2)**.5)
+            k.append(0.)
+        elif sec['type'] == 'ARC':
+            length.append(sec['radius'] * abs(radians(sec['angle'])))
+            k.append(copysign(1 / sec['radius'], sec['angle']))
+
+    first = sections[0]
+    start = (first['start'][0], first['start'][1])
+    end = (sections[-1]['end'][0], sections[-1]['end'][1])
+    if closed:
+        gap = ((end[0] - start[0])**2 + (end[1] - start[1])**2)**.5
+        if gap > 1e-9:
+            length.append(gap)
+            k.append(0.)
+
+    track = {'length': np.array(length),
+             'k_start': np.array(k),
+             'k_end': np.array(k),
+             'start': np.array(start),
+             'heading': atan2(first['end'][1] - first['start'][1], first['end'][0] - first['start'][0]),
+             'closed': closed}
+    if transition:
+        track = add_transitions(track, transition)
+    return index(track)
+
+
+def add_transitions(track, transition):
+    """Replace every curvature step between sections with a clothoid ramp."""
+    length, k_start, k_end = track['length'], track['k_start'], track['k_end']
+    n = len(length)
+    joins = n if track['closed'] else n - 1
+    # half of each ramp comes out of the section on either side of the join
+    half = np.zeros(n)
+    for j in range(joins):
+        a, b = j, (j + 1) % n
+        if k_end[a] != k_start[b]:
+            half[j] = min(transition / 2, length[a] / 2, length[b] / 2)
+
+    pieces = []
+    # a ramp across the start of a closed lap is split so that the lap still starts at distance zero
+    k_wrap = (k_end[-1] + k_start[0]) / 2
+    if half[-1]:
+        pieces.append((half[-1], k_wrap, k_start[0]))
+    for i in range(n):
+        pieces.append((length[i] - half[i - 1] - half[i], k_start[i], k_end[i]))
+        if half[i] and i < n - 1:
+            pieces.append((2 * half[i], k_end[i], k_start[i + 1]))
+        elif half[i]:
+            pieces.append((half[i], k_end[i], k_wrap))
+
+    length, k_start, k_end = np.array([p for p in pieces if p[0] > 0]).T
+    return dict(track, length=length, k_start=k_start, k_end=k_end)
+
+
+def index(track):
+    """Precompute the distance and heading at the start of every section."""
+    ends = np.cumsum(track['length'])
+    starts = np.concatenate(([0], ends[:-1]))
+    turn = (track['k_start'] + track['k_end']) / 2 * track['length']
+    headings = track['heading'] + np.concatenate(([0], np.cumsum(turn)[:-1]))
+    return dict(track, total=ends[-1], starts=starts, headings=headings)
+
+
+def save(filename, track):
+    """Store a track in a .npz file."""
+    np.savez(filename, length=track['length'], k_start=track['k_start'], k_end=track['k_end'],
+             start=track['start'], heading=track['heading'], closed=track['closed'])
+
+
+def load(filename):
+    """Read a track stored by save()."""
+    with np.load(filename) as f:
+        return index({'length': f['length'],
+                      'k_start': f['k_start'],
+                      'k_end': f['k_end'],
+                      'start': f['start'],
+                      'heading': float(f['heading']),
+                      'closed': bool(f['closed'])})
+
+
+def locate(track, dist):
+    """Return the section index and the distance into it for each distance."""
+    dist = np.asarray(dist, dtype=float)
+    if track['closed']:
+        dist = dist % track['total']
+    i = np.clip(np.searchsorted(track['starts'], dist, side='right') - 1, 0, len(track['length']) - 1)
+    return i, dist - track['starts'][i]
+
+
+def curvature(track, dist):
+    """Return the signed curvature at each distance."""
+    i, u = locate(track, dist)
+    slope = (track['k_end'][i] - track['k_start'][i]) / track['length'][i]
+    return track['k_start'][i] + slope * u
+
+
+def heading(track, dist):
+    """Return the heading in radians at each distance."""
+    i, u = locate(track, dist)
+    slope = (track['k_end'][i] - track['k_start'][i]) / track['length'][i]
+    return track['headings'][i] + track['k_start'][i] * u + slope * u**2 / 2
+
+
+def positions(track, dist):
+    """Return the x, y coords at each of an ascending array of distances.
+
+    Each step between neighbouring distances is integrated as a circular arc
+    with the heading and curvature at its midpoint, which is exact for
+    straights and arcs and second order within transitions.
+    """
+    dist = np.asarray(dist, dtype=float)
+    prev = np.concatenate(([0], dist[:-1]))
+    step = dist - prev
+    mid = prev + step / 2
+    k = curvature(track, mid)
+    chord = step * np.sinc(k * step / (2 * np.pi))
+    theta = heading(track, mid)
+    x = track['start'][0] + np.cumsum(chord * np.cos(theta))
+    y = track['start'][1] + np.cumsum(chord * np.sin(theta))
+    return x, y
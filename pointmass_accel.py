@@ -1,24 +1,15 @@
 """Point mass simulator for straight line acceleration."""
 
-from math import pi
-import matplotlib.pyplot as plot
+import argparse
+import numpy as np
+from scipy.integrate import solve_ivp
+from powertrain import Powertrain
+import telemetry
 
 
 def data_frame(index):
     """Return data in a different format."""
-    return {'time': data['time'][index],
-            'normal_force': data['normal_force'][index],
-            'friction_force': data['friction_force'][index],
-            'downforce': data['downforce'][index],
-            'drag_force': data['drag_force'][index],
-            'net_force': data['net_force'][index],
-            'acceleration': data['acceleration'][index],
-            'velocity': data['velocity'][index],
-            'distance': data['distance'][index],
-            'gear': data['gear'][index],
-            'engine_speed': data['engine_speed'][index],
-            'wheel_torque': data['wheel_torque'][index],
-            'engine_torque': data['engine_torque'][index]}
+    return dict(zip(data.dtype.names, data[index].tolist()))
 
 
 def add_plot(series):
@@ -27,42 +18,6 @@ def add_plot(series):
     plot.plot(data['time'], data[series])
 
 
-def engine_stuff(vel):
-    """Calculate engine parameters."""
-    for g, r in enumerate(gear_ratios):
-        gear = g
-        rpm = vel / (2 * pi * tire_radius) * 60 * final_drive * r
-        if rpm < upshift_RPM:
-            v = vel
-            break
-        elif rpm > torque_curve[-1][0]:
-            rpm = torque_curve[-1][0]
-            v = rpm * 2 * pi * tire_radius / 60 / final_drive / gear_ratios[gear]
-        elif rpm > upshift_RPM:
-            continue
-        else:
-            v = rpm * 2 * pi * tire_radius / 60 / final_drive / gear_ratios[gear]
-            break
-    if rpm <= torque_curve[0][0]:
-        torque = torque_curve[0][1]
-    elif rpm >= torque_curve[-1][0]:
-        torque = torque_curve[-1][1]
-    else:
-        for r in torque_curve:
-            if rpm > r[0]:
-                e1 = r
-                break
-        for r in torque_curve:
-            if rpm < r[0]:
-                e2 = r
-        torque = e1[1] + (rpm - e1[0]) * (e2[1] - e1[1]) / (e2[0] - e1[0])
-    return {'wheel_torque': torque * final_drive * gear_ratios[gear],
-            'engine_torque': torque,
-            'rpm': rpm,
-            'velocity': v,
-            'gear': gear}
-
-
 # simulation parameters
 DT = .00001  # seconds
 finish_time = 10  # seconds
@@ -98,75 +53,176 @@ torque_curve = [(2500, 33.72),  # (rpm, Nm)
                 (8000, 33.93),
                 (9000, 32.75),
                 (10000, 29.83)]
+powertrain = Powertrain(torque_curve, gear_ratios, final_drive, tire_radius, upshift_RPM)
+
+# telemetry channels, see telemetry.py
+CHANNELS = ('time', 'normal_force', 'friction_force', 'downforce', 'drag_force', 'net_force',
+            'acceleration', 'velocity', 'distance', 'gear', 'engine_speed', 'wheel_torque',
+            'engine_torque')
+CHANNEL_TYPES = {'gear': np.int8}
+ENGINE_CHANNELS = ('gear', 'engine_speed', 'wheel_torque', 'engine_torque')
+
+# the telemetry of the last run
+data = None
+
+
+def engine_channels(buf, velocity):
+    """Fill in the engine channels from the speed each step starts from."""
+    if telemetry.wants(buf, ENGINE_CHANNELS):
+        engine = powertrain.query(velocity)
+        telemetry.store(buf, {'gear': engine['gear'],
+                              'engine_speed': engine['rpm'],
+                              'wheel_torque': engine['wheel_torque'],
+                              'engine_torque': engine['torque']})
+
+
+def euler(channels=CHANNELS, out=None):
+    """Integrate the run with fixed time steps of DT and return its telemetry.
+
+    A time limited run knows its step count up front. A distance limited run
+    starts with room for the same number of steps and doubles it if needed.
+    If out names a .npy file, the steps are written to it as they are taken,
+    along with the velocity channel when engine channels are requested. out
+    may also be an array laid out as telemetry.allocate() expects, which is
+    filled in and returned cut to the steps taken, and ValueError is raised
+    if the run does not fit in it.
+    """
+    wanted = tuple(channels)
+    if 'velocity' not in wanted and not set(wanted).isdisjoint(ENGINE_CHANNELS):
+        # the engine channels are filled in afterwards from the stored speeds
+        wanted += ('velocity',)
+    buf = telemetry.allocate(int(finish_time / DT) + 2, wanted, CHANNELS, CHANNEL_TYPES, out)
+    fields = [CHANNELS.index(c) for c in buf.dtype.names if c not in ENGINE_CHANNELS]
+    columns = [buf[CHANNELS[j]] for j in fields]
+
+    velocity = distance = 0.
+    i = 0
+    while True:
+        time = i * DT
+        velocity = min(velocity, powertrain.v_top)
+        engine_force = powertrain.force_at(velocity)
+        downforce = 0.5 * rho * A * Cl * velocity
+        drag_force = 0.5 * rho * A * Cd * velocity
+        normal_force = VEHICLE_MASS * G + downforce
+        friction_force = MU * normal_force
+        net_force = min(friction_force, engine_force) - drag_force
+        if i == 0:
+            acceleration = net_force / VEHICLE_MASS
+        # the speed is stepped with the acceleration of the step before
+        velocity += acceleration * DT
+        distance += velocity * DT
+        acceleration = net_force / VEHICLE_MASS
+
+        # store new values
+        if i == len(buf):
+            if buf is out:
+                raise ValueError("output buffer of %d records is too short for the run" % len(buf))
+            buf = telemetry.resize(buf, 2 * len(buf))
+            columns = [buf[CHANNELS[j]] for j in fields]
+        step = (time, normal_force, friction_force, downforce, drag_force, net_force,
+                acceleration, velocity, distance)
+        for col, j in zip(columns, fields):
+            col[i] = step[j]
+        i += 1
+
+        if finish_mode == "distance" and distance > finish_distance \
+                or finish_mode == "time" and time > finish_time:
+            break
+
+    buf = buf[:i] if buf is out else telemetry.resize(buf, i)
+    if 'velocity' in buf.dtype.names:
+        # each speed was capped at top speed before the step after it
+        buf['velocity'][:-1] = np.minimum(buf['velocity'][:-1], powertrain.v_top)
+        engine_channels(buf, np.concatenate(([0.], buf['velocity'][:-1])))
+    return buf[list(channels)] if wanted != tuple(channels) else buf
+
+
+def acceleration(velocity):
+    """Return the acceleration at a single speed, holding the car at top speed."""
+    velocity = min(velocity, powertrain.v_top)
+    downforce = 0.5 * rho * A * Cl * velocity
+    drag_force = 0.5 * rho * A * Cd * velocity
+    net_force = min(MU * (VEHICLE_MASS * G + downforce), powertrain.force_at(velocity)) - drag_force
+    if velocity >= powertrain.v_top:
+        net_force = min(net_force, 0)
+    return net_force / VEHICLE_MASS
+
+
+def finish(t, y):
+    """Cross zero at the finish line."""
+    return y[0] - finish_distance
+
+
+finish.terminal = True
+
+
+def integrate(rtol=1e-10, atol=1e-10, channels=CHANNELS, out=None):
+    """Integrate the run with an adaptive solver and return the telemetry at its steps.
+
+    The engine force jumps at each upshift and stops rising at top speed, so
+    the solver is restarted at those speeds instead of stepping across them,
+    and the finish is located exactly by an event rather than by the first
+    step past it.
+    """
+    boundaries = list(powertrain.shift_vel) + [powertrain.v_top]
+    t_end = finish_time if finish_mode == "time" else np.inf
+    t, y = 0., np.zeros(2)
+    times, states = [np.zeros(1)], [np.zeros((2, 1))]
+    while True:
+        events = [finish] if finish_mode == "distance" else []
+        ahead = [b for b in boundaries if b > y[1] + 1e-6]
+        if ahead:
+            def shift(t, y, b=ahead[0]):
+                return y[1] - b
+            shift.terminal = True
+            events.append(shift)
+
+        sol = solve_ivp(lambda t, y: (y[1], acceleration(y[1])), (t, t_end), y,
+                        events=events, rtol=rtol, atol=atol)
+        times.append(sol.t[1:])
+        states.append(sol.y[:, 1:])
+        t, y = sol.t[-1], sol.y[:, -1]
+        if sol.status != 1 or finish_mode == "distance" and sol.t_events[0].size:
+            break
 
-# stored data
-data = {'time': [],
-        'normal_force': [],
-        'friction_force': [],
-        'downforce': [],
-        'drag_force': [],
-        'net_force': [],
-        'acceleration': [],
-        'velocity': [],
-        'distance': [],
-        'gear': [],
-        'engine_speed': [],
-        'wheel_torque': [],
-        'engine_torque': []}
-
-
-i = 0
-while True:
-    time = i * DT
-    i += 1
-    try:
-        engine = engine_stuff(data['velocity'][-1])
-        data['velocity'][-1] = engine['velocity']
-    except IndexError:
-        engine = engine_stuff(0)
-    try:
-        downforce = 0.5 * rho * A * Cl * data['velocity'][-1]
-        drag_force = 0.5 * rho * A * Cd * data['velocity'][-1]
-    except IndexError:
-        downforce = 0
-        drag_force = 0
-    engine_force = engine['wheel_torque'] / tire_radius
-    normal_force = VEHICLE_MASS * G + downforce
-    friction_force = MU * normal_force
-    net_force = min(friction_force, engine_force) - drag_force
-    acceleration = net_force / VEHICLE_MASS
-    try:
-        velocity = data['velocity'][-1] + data['acceleration'][-1] * DT
-        distance = data['distance'][-1] + velocity * DT
-    except IndexError:
-        velocity = acceleration * DT
-        distance = velocity * DT
-
-    # store new values
-    data['time'].append(time)
-    data['normal_force'].append(normal_force)
-    data['friction_force'].append(friction_force)
-    data['downforce'].append(downforce)
-    data['drag_force'].append(drag_force)
-    data['net_force'].append(net_force)
-    data['acceleration'].append(acceleration)
-    data['velocity'].append(velocity)
-    data['distance'].append(distance)
-    data['gear'].append(engine['gear'])
-    data['engine_speed'].append(engine['rpm'])
-    data['wheel_torque'].append(engine['wheel_torque'])
-    data['engine_torque'].append(engine['engine_torque'])
-
-    if finish_mode == "distance" and distance > finish_distance \
-            or finish_mode == "time" and time > finish_time:
-        break
-
-print(data['time'][-1])
-
-labels = []
-add_plot('distance')
-add_plot('velocity')
-add_plot('engine_torque')
-add_plot('acceleration')
-plot.legend(labels)
-plot.show()
+    time = np.concatenate(times)
+    distance, velocity = np.concatenate(states, axis=1)
+    buf = telemetry.allocate(len(time), channels, CHANNELS, CHANNEL_TYPES, out)
+    values = {'time': time, 'distance': distance, 'velocity': velocity}
+    values['downforce'] = 0.5 * rho * A * Cl * velocity
+    values['drag_force'] = 0.5 * rho * A * Cd * velocity
+    values['normal_force'] = VEHICLE_MASS * G + values['downforce']
+    values['friction_force'] = MU * values['normal_force']
+    values['acceleration'] = np.array([acceleration(v) for v in velocity])
+    values['net_force'] = VEHICLE_MASS * values['acceleration']
+    telemetry.store(buf, values)
+    engine_channels(buf, velocity)
+    return buf
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--solver', choices=('ivp', 'euler'), default='ivp',
+                        help='Integrate with an adaptive solver and events, or with fixed steps of DT. ')
+    parser.add_argument('-o', '--output', default=None, help='A .npy file to write the telemetry of every step to. ')
+    parser.add_argument('--no-plot', action='store_true', help='Skip plotting the run. ')
+    args = parser.parse_args()
+
+    if args.solver == "ivp":
+        data = integrate(out=args.output)
+    else:
+        data = euler(out=args.output)
+    print("%d steps" % len(data['time']))
+    print(data['time'][-1])
+    if args.no_plot:
+        exit()
+
+    import matplotlib.pyplot as plot
+
+    labels = []
+    add_plot('distance')
+    add_plot('velocity')
+    add_plot('engine_torque')
+    add_plot('acceleration')
+    plot.legend(labels)
+    plot.show()
@@ -1,277 +1,667 @@
 """Point mass simulator for straight line acceleration."""
 
-from math import pi, inf, sin, acos
-import matplotlib.pyplot as plt
-from functools import reduce
 import argparse
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import numpy as np
-from scipy import interpolate
-import warnings
-
-
-def mu_lat(fn):
-    """Allow adding load sensitivity."""
-    return 1.5
-
-
-def mu_long(fn):
-    """Allow adding load sensitivity."""
-    return 1.5
+from scipy import interpolate, ndimage
+import kernels
+import piecewise
+import profiling
+import telemetry
+import tires as tire_model
+import trackcache
+from powertrain import Powertrain
+
+# names of the per-station channels produced by the solver
+CHANNELS = ('t', 'dt', 'len', 'dist', 'x', 'y', 'radius', 'vel', 'gear', 'rpm',
+            'T_eng_max', 'F_eng_max', 'F_drag', 'F_df',
+            'F_normal_front', 'F_normal_rear', 'F_normal_total',
+            'F_lat_tire_max', 'V_corner_max', 'F_lat_vel_max', 'F_lat', 'A_lat',
+            'F_long_fric_lim', 'F_long_cp', 'F_long_net', 'A_long')
+CHANNEL_TYPES = {'gear': np.int8}
+
+# channels needed by summary()
+SUMMARY = ('t', 'dist', 'vel', 'A_lat', 'A_long')
+
+# channels worked out from the forces on the car after each sweep
+FORCE_CHANNELS = ('gear', 'rpm', 'T_eng_max', 'F_eng_max', 'F_drag', 'F_df',
+                  'F_normal_front', 'F_normal_rear', 'F_normal_total', 'F_lat_tire_max',
+                  'F_lat_vel_max', 'F_lat', 'A_lat', 'F_long_fric_lim', 'F_long_cp', 'F_long_net')
+
+# curvature smoothing in meters for spline tracks, enough to hide the ringing of the spline at section joins
+SMOOTH = 0.02
+
+# longest step in meters allowed by adaptive station spacing
+DD_MAX = 1.
+
+# corners that could be taken faster than this in m/s are treated as straights
+V_STRAIGHT = 100.
 
+# constants
+G = 9.8  # meters per second
+rho = 1.2041  # air density in kg/m^3
 
-def dist(x1, y1, x2, y2):
-    """Calculate Euclidean distance."""
-    return ((x1 - x2)**2 + (y1 - y2)**2)**0.5
+# vehicle parameters
+VEHICLE = {'VEHICLE_MASS': 190 + 69,  # mass with driver in kg
+           'Cd': 0.436,  # coefficient of drag
+           'Cl': 1.07,  # coefficient of lift
+           'A': 3.84,  # frontal area in m^2
+           'tire_radius': 0.2286,  # in meters
+           'CG_long': 0.49,  # percent rear
+           'CP_long': 0.54,  # percent rear
+           'CG_vert': 0.3124,
+           'wheelbase': 1.575,
+           'trackwidth_front': 1.270,
+           'trackwidth_rear': 1.219,
+
+           # transmission parameters
+           'upshift_RPM': 9500,
+           'final_drive': 61 / 23 * 37 / 13,
+           'gear_ratios': [35 / 14,
+                           30 / 15,
+                           31 / 19,
+                           28 / 21,
+                           23 / 21],
+           'torque_curve': [(7000, 36.18),  # (rpm, Nm)
+                            (8000, 33.59),
+                            (9000, 31.29),
+                            (10000, 29.83)]}
+
+# parameter names like gear_ratios[2] stand for a single gear
+GEAR = re.compile(r'gear_ratios\[(\d+)\]')
+
+
+def parameter(veh, name):
+    """Return a parameter of a vehicle, where names like gear_ratios[2] give a single gear."""
+    gear = GEAR.fullmatch(name)
+    return veh['gear_ratios'][int(gear.group(1))] if gear else veh[name]
+
+
+def parameter_changes(veh, params):
+    """Return the changes to a vehicle that set the named parameters, see parameter()."""
+    changes = {}
+    for name, value in params.items():
+        gear = GEAR.fullmatch(name)
+        if gear:
+            changes['gear_ratios'] = list(changes.get('gear_ratios', veh['gear_ratios']))
+            changes['gear_ratios'][int(gear.group(1))] = value
+        else:
+            changes[name] = value
+    return changes
 
 
-def get_point(dist):
+def get_point(tck, dist):
     """Return the x, y coords of the track at a given distance."""
     x, y = interpolate.splev(dist, tck)
     return float(x), float(y)
 
 
-def calc_radius(i):
-    """Get the instantaneous radius at a point."""
-    bx, by = track_points[i - 1]
-    ax, ay = track_points[i]
-    cx, cy = track_points[i + 1]
-
-    a = dist(bx, by, cx, cy)
-    b = dist(ax, ay, cx, cy)
-    c = dist(ax, ay, bx, by)
-
-    pa = acos(max(-1, min(1, (b**2 + c**2 - a**2) / (2 * b * c))))
-    warnings.simplefilter("ignore")
-    try:
-        r = a / (2 * sin(pi - pa))
-    except ZeroDivisionError:
-        r = inf
-    warnings.simplefilter("default")
-    s = (ax - bx) * (cy - by) - (ay - by) * (cx - bx)
-    return r * (-1 if s > 0 else 1)
-
-
-def ic_engine(vel):
-    """Calculate engine parameters."""
-    for g, gr in enumerate(gear_ratios):
-        gear = g
-        rpm = vel / (2 * pi * tire_radius) * 60 * final_drive * gr
-        if rpm < upshift_RPM:
-            break
-        elif rpm > torque_curve[-1][0]:
-            rpm = torque_curve[-1][0]
-            continue
-        else:
-            continue
-    if rpm <= torque_curve[0][0]:
-        torque = torque_curve[0][1]
-        rpm = torque_curve[0][0]
-    elif rpm >= torque_curve[-1][0]:
-        torque = torque_curve[-1][1]
-        rpm = torque_curve[-1][0]
+def radii(k, smooth, ds):
+    """Convert signed curvature at evenly spaced stations to signed radius.
+
+    Left turns are negative. If smooth is given, the curvature is first
+    smoothed around the lap with a Gaussian of that standard deviation in
+    meters.
+    """
+    if smooth:
+        k = ndimage.gaussian_filter1d(k, smooth / ds, mode='wrap')
+    with np.errstate(divide='ignore'):
+        return -1 / k
+
+
+def calc_radii(tck, dist, smooth=0.):
+    """Get the signed radius at evenly spaced distances from the analytic spline derivatives.
+
+    The spline fit rings for a few knots wherever two track sections meet,
+    which shows up as spurious tight corners once the stations are closer
+    together than about a centimeter, so it usually wants a little smoothing.
+    """
+    dx, dy = interpolate.splev(dist, tck, der=1)
+    ddx, ddy = interpolate.splev(dist, tck, der=2)
+    k = (dx * ddy - dy * ddx) / (dx**2 + dy**2)**1.5
+    return radii(k, smooth, dist[1] - dist[0])
+
+
+@profiling.timed('discretize')
+def discretize(filename, dd, smooth=None, tol=None, dd_max=DD_MAX):
+    """Discretize a track file into evenly spaced stations roughly dd apart.
+
+    The file is either a spline (.npy) or a sectioned track (.npz), both
+    written by dxf_to_tck.py. Sectioned tracks give the exact curvature of
+    every station, so they are not smoothed unless asked to be. If tol is
+    given, the stations are then thinned out by adapt(), and dd is the
+    shortest step.
+    """
+    if filename.endswith('.npz'):
+        trk = piecewise.load(filename)
+        totaldist = trk['total']
+        smooth = smooth or 0.
+    else:
+        npload = np.load(filename, allow_pickle=True)
+        tck = list(npload[:3])
+        totaldist = npload[3]
+        smooth = SMOOTH if smooth is None else smooth
+
+    numdiv = int(round(totaldist / dd))
+    dd = totaldist / numdiv
+
+    # stations are evenly spaced around the closed lap, so the last one is not a copy of the first
+    td = np.linspace(0, totaldist, numdiv, endpoint=False)
+    if filename.endswith('.npz'):
+        tx, ty = piecewise.positions(trk, td)
+        radius = radii(piecewise.curvature(trk, td), smooth, dd)
     else:
-        for r in torque_curve:
-            if rpm > r[0]:
-                e1 = r
+        tx, ty = interpolate.splev(td, tck)
+        radius = calc_radii(tck, td, smooth)
+
+    track = {'dd': dd,
+             'x': tx,
+             'y': ty,
+             'len': np.full(numdiv, dd),
+             'dist': dd * np.arange(1, numdiv + 1),
+             'radius': radius}
+    if tol:
+        track = adapt(track, tol, dd_max)
+    return track
+
+
+def adapt(track, tol, dd_max=DD_MAX):
+    """Merge the steps of an evenly discretized track where the curvature allows.
+
+    Steps are placed so that each one turns through about tol radians at
+    most, counting the rate of change of curvature as well as the curvature
+    itself, and none is longer than dd_max. Long straights get a few coarse
+    steps while corner entries and section joins keep the original spacing.
+    The stations kept are a subset of the original ones, and each merged step
+    takes the tightest radius along it.
+    """
+    dd = track['dd']
+    k = -1 / track['radius']
+    dk = (np.roll(k, -1) - np.roll(k, 1)) / (2 * dd)
+    # the most stations a step can take and stay shorter than dd_max, which a step always ends
+    # within since it gathers less than tol of weight before its last station
+    most = max(int(np.ceil(dd_max / dd - 1e-9)) - 1, 1)
+    w = np.maximum(np.abs(k) + np.sqrt(np.abs(dk)), tol / ((most - 0.5) * dd))
+
+    # start a new step each time the accumulated weight passes another multiple of tol
+    weight = np.concatenate(([0], np.cumsum(w[:-1] * dd)))
+    idx = np.flatnonzero(np.diff(np.floor(weight / tol), prepend=-1))
+
+    start = track['dist'][idx] - track['len'][idx]
+    length = np.diff(np.append(start, track['dist'][-1]))
+    radius = np.copysign(np.minimum.reduceat(np.abs(track['radius']), idx), track['radius'][idx])
+    return {'dd': dd,
+            'x': track['x'][idx],
+            'y': track['y'][idx],
+            'len': length,
+            'dist': start + length,
+            'radius': radius}
+
+
+def load_track(filename, dd, smooth=None, tol=None, dd_max=DD_MAX, cache=True, cache_dir=None):
+    """Return the discretized track, reusing a cached copy when there is one."""
+    if not cache:
+        return discretize(filename, dd, smooth, tol, dd_max)
+    with profiling.stage('load_track'):
+        return trackcache.load(filename, dd, discretize, cache_dir,
+                               smooth=smooth if smooth is None else float(smooth),
+                               tol=tol if tol is None else float(tol), dd_max=float(dd_max))
+
+
+@profiling.timed('powertrain')
+def make_powertrain(veh):
+    """Build the powertrain lookup tables for a vehicle."""
+    return Powertrain(veh['torque_curve'], veh['gear_ratios'], veh['final_drive'],
+                      veh['tire_radius'], veh['upshift_RPM'])
+
+
+def axle_loads(df, veh):
+    """Return the front and rear normal loads with downforce df."""
+    mass = veh['VEHICLE_MASS']
+    return (mass * G * (1 - veh['CG_long']) + df * (1 - veh['CP_long']),
+            mass * G * veh['CG_long'] + df * veh['CP_long'])
+
+
+def lat_grip(df, veh, tire=tire_model.TIRE):
+    """Return the peak lateral force of both axles together with downforce df."""
+    front, rear = axle_loads(df, veh)
+    return tire_model.axle_lat(front, tire) + tire_model.axle_lat(rear, tire)
+
+
+def loads(vel, radius, veh, tire=tire_model.TIRE):
+    """Return the speed dependent force channels."""
+    mass = veh['VEHICLE_MASS']
+    f = {}
+    f['F_drag'] = 0.5 * rho * veh['A'] * veh['Cd'] * vel
+    f['F_df'] = 0.5 * rho * veh['A'] * veh['Cl'] * vel
+
+    f['F_normal_front'], f['F_normal_rear'] = axle_loads(f['F_df'], veh)
+
+    f['F_normal_total'] = f['F_normal_front'] + f['F_normal_rear']
+
+    f['F_lat_tire_max'] = tire_model.axle_lat(f['F_normal_front'], tire) + tire_model.axle_lat(f['F_normal_rear'], tire)
+    f['F_lat_vel_max'] = mass * vel**2 / np.abs(radius)
+    f['F_lat'] = np.minimum(f['F_lat_tire_max'], f['F_lat_vel_max'])
+
+    f['A_lat'] = f['F_lat'] / mass
+
+    f['F_long_fric_lim'] = ((1 - (f['F_lat'] / f['F_lat_tire_max'])**2) * tire_model.axle_long(f['F_normal_rear'], tire)**2)**.5
+    return f
+
+
+def corner_speeds(radius, veh, iterations=50, tol=1e-9, tire=tire_model.TIRE):
+    """Solve for the tire limited cornering speed at every station, including downforce.
+
+    Each station stops iterating once its own speed has converged, so its
+    result does not depend on the other stations being solved with it. The
+    vehicle parameters may be arrays that broadcast against radius. Stations
+    that could be taken faster than V_STRAIGHT get an infinite speed, which
+    keeps load sensitive grip from being evaluated at absurd downforce.
+    """
+    keys = ('VEHICLE_MASS', 'A', 'Cl', 'CG_long', 'CP_long')
+    shape = np.broadcast_shapes(np.shape(radius), *(np.shape(veh[key]) for key in keys))
+    absr = np.broadcast_to(np.abs(radius), shape).ravel()
+    per_station = {key: np.broadcast_to(veh[key], shape).ravel() for key in keys if np.ndim(veh[key])}
+    vel = np.zeros(absr.size)
+    # only the stations still converging are worked on
+    todo = np.arange(absr.size)
+    with np.errstate(invalid='ignore'):
+        for _ in range(iterations):
+            sub = {key: per_station[key][todo] if key in per_station else veh[key] for key in keys}
+            new = np.minimum(np.sqrt(lat_grip(0.5 * rho * sub['A'] * sub['Cl'] * vel[todo], sub, tire)
+                                     / sub['VEHICLE_MASS'] * absr[todo]), V_STRAIGHT)
+            converged = (new == V_STRAIGHT) | (np.abs(new - vel[todo]) < tol)
+            vel[todo] = new
+            todo = todo[~converged]
+            if not len(todo):
                 break
-        for r in torque_curve:
-            if rpm < r[0]:
-                e2 = r
-        torque = e1[1] + (rpm - e1[0]) * (e2[1] - e1[1]) / (e2[0] - e1[0])
-
-    return {'torque': torque,
-            'rpm': rpm,
-            'vel': min(rpm * 2 * pi * tire_radius / (60 * final_drive * gr), vel),
-            'gear': gear}
-
-
-def correct_frame(i):
-    """Do reverse calculations to correct a frame for an engine limited velocity."""
-    eng = ic_engine(d[i]['vel'])
-    if d[i]['vel'] <= eng['vel'] + .00001:
+    vel[vel == V_STRAIGHT] = np.inf
+    return vel.reshape(shape)
+
+
+@profiling.timed('ggv')
+def make_ggv(veh, powertrain, tire=tire_model.TIRE):
+    """Tabulate the quasi steady state g-g-speed envelope of a vehicle.
+
+    Apart from drag, everything the sweeps need from the car depends on
+    speed alone: downforce sets the axle loads, the loads set the tire grip
+    and the gear sets the engine force. These are tabulated once on the
+    speed grid of the powertrain, so a station of a sweep only looks them up.
+    The peak accelerations are kept as well for comparison with logged data.
+    """
+    vel = powertrain.vel
+    mass = veh['VEHICLE_MASS']
+    front, rear = axle_loads(0.5 * rho * veh['A'] * veh['Cl'] * vel, veh)
+    env = {'dv': powertrain.dv,
+           'v_top': powertrain.v_top,
+           'vel': vel,
+           'F_lat_max': tire_model.axle_lat(front, tire) + tire_model.axle_lat(rear, tire),
+           'F_long_max': tire_model.axle_long(rear, tire),
+           'F_drive': powertrain.force,
+           'F_drag': 0.5 * rho * veh['A'] * veh['Cd'] * vel}
+    env['A_lat_max'] = env['F_lat_max'] / mass
+    env['A_long_max'] = (np.minimum(env['F_long_max'], env['F_drive']) - env['F_drag']) / mass
+    env['A_brake_max'] = (-env['F_long_max'] - env['F_drag']) / mass
+    return env
+
+
+def save_ggv(path, ggv):
+    """Write the peak accelerations of an envelope in g against speed to a CSV file."""
+    cols = ('A_lat_max', 'A_long_max', 'A_brake_max')
+    np.savetxt(path, np.column_stack([ggv['vel']] + [ggv[c] / G for c in cols]),
+               delimiter=',', header=','.join(('vel',) + cols), comments='')
+
+
+def sweep_args(veh, ggv):
+    """Return the vehicle constants and envelope tables shared by both sweep kernels.
+
+    For a batch of vehicles the constants are arrays, see simulate_batch().
+    """
+    num = float if np.isscalar(veh['VEHICLE_MASS']) else np.asarray
+    return (num(veh['VEHICLE_MASS']), 0.5 * rho * veh['A'] * veh['Cd'],
+            ggv['dv'], ggv['F_lat_max'], ggv['F_long_max'])
+
+
+def apexes(v_corner):
+    """Return the stations where the corner speed has a local minimum, taking the first of a flat stretch."""
+    prev = np.concatenate(([np.inf], v_corner[:-1]))
+    nxt = np.concatenate((v_corner[1:], [np.inf]))
+    return np.flatnonzero((v_corner < prev) & (v_corner <= nxt))
+
+
+def split_apexes(v_corner, chunks):
+    """Return the apexes that split a lap into up to chunks segments of about even length.
+
+    The lap is cut into chunks even stretches and split at the slowest apex
+    of each after the first. The car is all but sure to be held to the
+    corner speed there, so a segment is rarely started from the wrong speed,
+    where most of the apexes that noise in the curvature makes are never reached.
+    """
+    a = apexes(v_corner)
+    stretch = a * chunks // len(v_corner)
+    a, stretch = a[stretch > 0], stretch[stretch > 0]
+    order = np.lexsort((v_corner[a], stretch))
+    first = np.flatnonzero(np.diff(stretch[order], prepend=-1))
+    return np.sort(a[order[first]])
+
+
+def forward_segments(w, veh, ggv, pool, threads, v0=0.):
+    """Run the forward sweep as independent apex to apex segments on a pool of threads.
+
+    The lap is split into one segment for each of the threads of the pool,
+    see split_apexes(). The first
+    segment starts at speed v0, and each segment after an apex is started at
+    the corner speed of the apex, which is where the sequential sweep leaves
+    the car whenever the apex is reached. The segments are then checked in
+    order, and one whose start turns out wrong is run again from the speed
+    the segment before it reached, so the result is identical to a single
+    sweep. Returns the stations capped at top speed.
+    """
+    n = len(w['vel'])
+    a = split_apexes(w['V_corner_max'], threads)
+    starts = np.concatenate(([0], a[a < n - 1] + 1))
+    ends = np.append(starts[1:], n)
+    v_start = w['V_corner_max'][starts - 1].copy()
+    v_start[v_start > ggv['v_top'] + .00001] = ggv['v_top']
+    v_start[0] = v0
+    capped = np.zeros(n, dtype=bool)
+    args = sweep_args(veh, ggv)
+
+    def run(k):
+        i, j = starts[k], ends[k]
+        capped[i:j] = False
+        kernels.forward_sweep(w['vel'][i:j], w['A_long'][i:j], capped[i:j], w['absr'][i:j],
+                              w['V_corner_max'][i:j], w['len'][i:j], *args,
+                              ggv['F_drive'], ggv['v_top'], v_start[k])
+
+    profiling.count('forward_segments', len(starts))
+    list(pool.map(run, range(len(starts))))
+    for k in range(1, len(starts)):
+        reached = w['vel'][starts[k] - 1]
+        if reached != v_start[k]:
+            profiling.count('forward_segments')
+            v_start[k] = reached
+            run(k)
+    return capped
+
+
+def backward_segments(w, veh, ggv, pool, threads):
+    """Run the braking sweep as independent apex to apex segments on a pool of threads.
+
+    The lap is split as for forward_segments(), and each segment is first
+    braked back from the forward speed at the apex it ends on. The segments
+    are then checked from the last one back, and one is run again from the
+    final speed at its end apex if braking for a later corner reaches back
+    past the apex.
+    Returns the braking stations.
+    """
+    n = len(w['vel'])
+    a = split_apexes(w['V_corner_max'], threads)
+    edges = np.concatenate(([0], a[(a > 0) & (a < n - 1)], [n - 1]))
+    fwd, fwd_acc = w['vel'].copy(), w['A_long'].copy()
+    top = fwd[edges[1:]].copy()
+    braking = np.zeros(n, dtype=bool)
+    args = sweep_args(veh, ggv)
+
+    def run(k):
+        i, j = edges[k], edges[k + 1]
+        # the end station belongs to the next segment, so it is braked from in a private copy
+        vel = np.append(fwd[i:j], top[k])
+        w['A_long'][i:j] = fwd_acc[i:j]
+        braking[i:j] = False
+        kernels.backward_sweep(vel, w['A_long'][i:j + 1], braking[i:j + 1], w['absr'][i:j + 1],
+                               w['len'][i:j + 1], *args)
+        w['vel'][i:j] = vel[:-1]
+
+    profiling.count('backward_segments', len(edges) - 1)
+    list(pool.map(run, range(len(edges) - 1)))
+    for k in range(len(edges) - 3, -1, -1):
+        final = w['vel'][edges[k + 1]]
+        if final != top[k]:
+            profiling.count('backward_segments')
+            top[k] = final
+            run(k)
+    return braking
+
+
+def forward_pass(s, w, veh, powertrain, ggv, pool=None, threads=None, v0=0., tire=tire_model.TIRE):
+    """Integrate the acceleration limited velocity profile from speed v0, by default a standing start.
+
+    The solver arrays in w are updated in place, and the force channels of s
+    are filled in as seen on the way out of the previous station. Given a
+    pool of threads, the lap is split at its apexes, see forward_segments().
+    """
+    with profiling.stage('forward_sweep'):
+        if pool is not None:
+            capped = forward_segments(w, veh, ggv, pool, threads, v0)
+        else:
+            capped = np.zeros(len(w['vel']), dtype=bool)
+            kernels.forward_sweep(w['vel'], w['A_long'], capped, w['absr'], w['V_corner_max'], w['len'],
+                                  *sweep_args(veh, ggv), ggv['F_drive'], ggv['v_top'], v0)
+    if not telemetry.wants(s, FORCE_CHANNELS):
         return
-    d[i]['vel'] = eng['vel']
-    d[i]['rpm'] = eng['rpm']
-    d[i]['A_long'] = 0
-    d[i]['dt'] = min([x for x in np.roots([0.5 * d[i]['A_long'], d[i - 1]['vel'], -dd]) if x > 0])
-
-
-parser = argparse.ArgumentParser()
-req = parser.add_argument_group('required named arguments')
-req.add_argument('-f', '--filename', required=True, help='A numpy file output by dxf_to_tck.py. ')
-parser.add_argument('-d', '--delta', type=float, default=0.01, help='The timestep to use for simulation. ')
-args = parser.parse_args()
-
-npload = np.load(args.filename)
-tck = npload[:3]
-totaldist = npload[3]
-radii = npload[4]
-
-# simulation parameters
-dd = args.delta  # meters
-plot_mode = "time"  # track or time
-
-# constants
-G = 9.8  # meters per second
-rho = 1.2041  # air density in kg/m^3
 
-# vehicle parameters
-VEHICLE_MASS = 190 + 69  # mass with driver in kg
-Cd = 0.436  # coefficient of drag
-Cl = 1.07  # coefficient of lift
-A = 3.84  # frontal area in m^2
-tire_radius = 0.2286  # in meters
-CG_long = 0.49  # percent rear
-CP_long = 0.54  # percent rear
-CG_vert = 0.3124
-wheelbase = 1.575
-trackwidth_front = 1.270
-trackwidth_rear = 1.219
-
-# transmission parameters
-upshift_RPM = 9500
-final_drive = 61 / 23 * 37 / 13
-gear_ratios = [35 / 14,
-               30 / 15,
-               31 / 19,
-               28 / 21,
-               23 / 21]
-torque_curve = [(7000, 36.18),  # (rpm, Nm)
-                (8000, 33.59),
-                (9000, 31.29),
-                (10000, 29.83)]
-
-radii = [inf]
-numdiv = int(round(totaldist / dd))
-dd = totaldist / numdiv
-print("Generating track with step size = %f" % dd)
-
-td = np.linspace(0, totaldist, numdiv)
-tx, ty = interpolate.splev(td, tck)
-track_points = list(zip(tx, ty))
-
-for i in range(len(track_points)):
-    radii.append(calc_radius(i - 2))
-radii.append(calc_radius(i - 1))
-
-# initial data required to bootstrap the simulation
-d = [{'t': 0,
-      'vel': 0,
-      'dist': 0,
-      'A_long': 0}]
-
-print("Simulating")
-for i in range(len(track_points)):
-    s = str(round(i * 100 / len(track_points))) + ('%\t[') + (i * 50 // len(track_points)) * '#' + (int(49 - i * 50 // len(track_points)) * ' ' + ']')
-    print('\r' + s, end='')
-
-    d[i]['len'] = dd
-    d[i]['dist'] = d[i - 1]['dist'] + d[i]['len']
-    d[i]['x'], d[i]['y'] = track_points[i]
-
-    eng = ic_engine(d[i - 1]['vel'])
-    d[i]['gear'] = eng['gear']
-    d[i]['rpm'] = eng['rpm']
-    d[i]['T_eng_max'] = eng['torque'] * final_drive * gear_ratios[d[i]['gear']]
-    d[i]['F_eng_max'] = d[i]['T_eng_max'] / tire_radius
-
-    d[i]['F_drag'] = 0.5 * rho * A * Cd * d[i - 1]['vel']
-    d[i]['F_df'] = 0.5 * rho * A * Cl * d[i - 1]['vel']
-
-    d[i]['F_normal_front'] = VEHICLE_MASS * G * (1 - CG_long) + d[i]['F_df'] * (1 - CP_long)
-    d[i]['F_normal_rear'] = VEHICLE_MASS * G * CG_long + d[i]['F_df'] * CP_long
-
-    d[i]['F_normal_total'] = d[i]['F_normal_front'] + d[i]['F_normal_rear']
-
-    d[i]['radius'] = radii[i]
-
-    d[i]['F_lat_tire_max'] = d[i]['F_normal_total'] * mu_lat(d[i]['F_normal_total'])
-    d[i]['V_corner_max'] = np.sqrt(d[i]['F_lat_tire_max'] / VEHICLE_MASS * abs(d[i]['radius']))
-    d[i]['F_lat_vel_max'] = VEHICLE_MASS * d[i - 1]['vel']**2 / abs(d[i]['radius'])
-    d[i]['F_lat'] = min(d[i]['F_lat_tire_max'], d[i]['F_lat_vel_max'])
-
-    d[i]['A_lat'] = d[i]['F_lat'] / VEHICLE_MASS
-
-    d[i]['F_long_fric_lim'] = ((1 - (d[i]['F_lat'] / d[i]['F_lat_tire_max'])**2) * (d[i]['F_normal_rear'] * mu_long(d[i]['F_normal_rear']))**2)**.5
-
-    d[i]['F_long_cp'] = min(d[i]['F_long_fric_lim'], d[i]['F_eng_max'])
-
-    d[i]['F_long_net'] = d[i]['F_long_cp'] - d[i]['F_drag']
-
-    d[i]['A_long'] = d[i]['F_long_net'] / VEHICLE_MASS
-
-    if d[i]['V_corner_max'] < ((d[i - 1]['vel'])**2 + 2 * d[i]['A_long'] * dd)**.5:
-        d[i]['vel'] = d[i]['V_corner_max']
-        d[i]['A_long'] = 0
-    else:
-        d[i]['vel'] = ((d[i - 1]['vel'])**2 + 2 * d[i]['A_long'] * dd)**.5
-
-    d[i]['dt'] = min([x for x in np.roots([0.5 * d[i]['A_long'], d[i - 1]['vel'], -dd]) if x > 0])
-
-    correct_frame(i)
-    d.append({})
-
-print()
-d = d[:-1]
-
-for i in range(len(track_points) - 1)[::-1]:
-    if d[i]['vel'] > d[i + 1]['vel']:
-        d[i]['F_drag'] = 0.5 * rho * A * Cd * d[i + 1]['vel']
-        d[i]['F_df'] = 0.5 * rho * A * Cl * d[i + 1]['vel']
-
-        d[i]['F_normal_front'] = VEHICLE_MASS * G * (1 - CG_long) + d[i]['F_df'] * (1 - CP_long)
-        d[i]['F_normal_rear'] = VEHICLE_MASS * G * CG_long + d[i]['F_df'] * CP_long
-
-        d[i]['F_normal_total'] = d[i]['F_normal_front'] + d[i]['F_normal_rear']
-
-        d[i]['F_lat_tire_max'] = d[i]['F_normal_total'] * mu_lat(d[i]['F_normal_total'])
-        d[i]['F_lat_vel_max'] = VEHICLE_MASS * d[i + 1]['vel']**2 / abs(d[i]['radius'])
-        d[i]['F_lat'] = min(d[i]['F_lat_tire_max'], d[i]['F_lat_vel_max'])
-
-        d[i]['A_lat'] = d[i]['F_lat'] / VEHICLE_MASS
-
-        d[i]['F_long_fric_lim'] = ((1 - (d[i]['F_lat'] / d[i]['F_lat_tire_max'])**2) * (d[i]['F_normal_rear'] * mu_long(d[i]['F_normal_rear']))**2)**.5
-
-        d[i]['F_long_cp'] = -d[i]['F_long_fric_lim']
-
-        d[i]['F_long_net'] = d[i]['F_long_cp'] - d[i]['F_drag']
-
-        d[i]['A_long'] = d[i]['F_long_net'] / VEHICLE_MASS
-
-        d[i]['vel'] = min(d[i]['vel'], ((d[i + 1]['vel'])**2 + 2 * -d[i]['A_long'] * dd)**.5)
-
-        eng = ic_engine(d[i + 1]['vel'])
-        d[i]['gear'] = eng['gear']
-        d[i]['rpm'] = eng['rpm']
-
-        d[i]['dt'] = min([x for x in np.roots([0.5 * -d[i]['A_long'], d[i + 1]['vel'], -dd]) if x > 0])
-
-cum = 0
-for f in d:
-    cum += f['dt']
-    f['t'] = cum
-
-l = {key: [item[key] for item in d]
-     for key in list(reduce(
-         lambda x, y: x.union(y),
-         (set(dicts.keys()) for dicts in d)
-     ))
-     }
-
-print("Lap length = %s m" % str(round(l['dist'][-1], 2)))
-print("Lap time = %s s" % str(round(l['t'][-1], 4)))
-print("Max velocity = %s m/s" % str(round(max(l['vel']), 3)))
-print("Max lateral accel = %s g" % str(round(max(l['A_lat']) / G, 3)))
-print("Max longitudinal accel = %s g" % str(round(max(l['A_long']) / G, 3)))
-print("Min longitudinal accel = %s g" % str(round(min(l['A_long']) / G, 3)))
+    with profiling.stage('forward_channels'):
+        v_prev = np.concatenate(([v0], w['vel'][:-1]))
+        eng = powertrain.query(v_prev)
+        f = loads(v_prev, w['radius'], veh, tire)
+        f['gear'] = eng['gear']
+        f['rpm'] = np.where(capped, powertrain.curve_rpm[-1], eng['rpm'])
+        f['T_eng_max'] = eng['wheel_torque']
+        f['F_eng_max'] = eng['force']
+        f['F_long_cp'] = np.minimum(f['F_long_fric_lim'], f['F_eng_max'])
+        f['F_long_net'] = f['F_long_cp'] - f['F_drag']
+        telemetry.store(s, f)
+
+
+def backward_pass(s, w, veh, powertrain, ggv, pool=None, threads=None, tire=tire_model.TIRE):
+    """Limit the velocity profile by braking into every slower station."""
+    with profiling.stage('backward_sweep'):
+        if pool is not None:
+            braking = backward_segments(w, veh, ggv, pool, threads)
+        else:
+            braking = np.zeros(len(w['vel']), dtype=bool)
+            kernels.backward_sweep(w['vel'], w['A_long'], braking, w['absr'], w['len'],
+                                   *sweep_args(veh, ggv))
+    if not telemetry.wants(s, FORCE_CHANNELS):
+        return
 
-if plot_mode == "track":
-    plt.set_cmap('cool')
-    plt.scatter(l['x'], l['y'], c=[min(max(d, -30), 30) for i, d in enumerate(l['vel'])], s=1)
-    plt.axis('equal')
-    plt.colorbar()
-    plt.show()
-elif plot_mode == "time":
-    plt.scatter([x for i, x in enumerate(l['t'])][:2000], [d for i, d in enumerate(l['vel'])][:2000], label="vel")
-    plt.legend(loc='best')
-    plt.show()
+    with profiling.stage('backward_channels'):
+        v_next = np.concatenate((w['vel'][1:], [0]))[braking]
+        b = loads(v_next, w['radius'][braking], veh, tire)
+        b['F_long_cp'] = -b['F_long_fric_lim']
+        b['F_long_net'] = b['F_long_cp'] - b['F_drag']
+        b['gear'], b['rpm'] = powertrain.select_gear(v_next)
+        telemetry.store(s, b, braking)
+
+
+def step_time(v_prev, v_next, dist):
+    """Return the time to cover each step at constant acceleration between its end speeds."""
+    with np.errstate(divide='ignore'):
+        return 2 * dist / (v_prev + v_next)
+
+
+def solver_state(track, veh, tire=tire_model.TIRE):
+    """Return the per-station arrays the sweeps work on, before the first sweep."""
+    n = len(track['len'])
+    with profiling.stage('corner_speeds'):
+        v_corner = corner_speeds(track['radius'], veh, tire=tire)
+    return {'vel': np.zeros(n),
+            'A_long': np.zeros(n),
+            'radius': track['radius'],
+            'absr': np.abs(track['radius']),
+            'len': track['len'],
+            'V_corner_max': v_corner}
+
+
+@profiling.timed('simulate')
+def simulate(track, veh=VEHICLE, channels=CHANNELS, out=None, powertrain=None, ggv=None, pool=None, threads=None,
+             v0=0., tire=tire_model.TIRE):
+    """Simulate a lap of a discretized track and return the requested per-station channels.
+
+    out is passed on to telemetry.allocate(), so the channels can be written
+    straight to a .npy file or into a row of a larger memory map. The
+    powertrain tables and g-g-speed envelope of the vehicle are built unless
+    given. Given a thread pool and its number of threads, the sweeps are
+    split into that many apex to apex segments run on it. The lap starts at
+    speed v0, so a rolling start can follow on from the end of another lap.
+    The grip of every station comes from the tire, see tires.py; a given
+    envelope must have been built for the same tire.
+    """
+    if pool is not None and not threads:
+        raise ValueError("give the number of threads of the pool")
+    if powertrain is None:
+        powertrain = make_powertrain(veh)
+    if ggv is None:
+        ggv = make_ggv(veh, powertrain, tire)
+
+    s = telemetry.allocate(len(track['len']), channels, CHANNELS, CHANNEL_TYPES, out)
+    w = solver_state(track, veh, tire)
+    forward_pass(s, w, veh, powertrain, ggv, pool, threads, v0, tire)
+    backward_pass(s, w, veh, powertrain, ggv, pool, threads, tire)
+    w['dt'] = step_time(np.concatenate(([v0], w['vel'][:-1])), w['vel'], w['len'])
+    w['t'] = np.cumsum(w['dt'])
+    telemetry.store(s, track)
+    telemetry.store(s, w)
+    profiling.count('laps')
+    profiling.count('stations', len(w['vel']))
+    return s
+
+
+def batch_vehicle(vehicles):
+    """Stack the scalar parameters of several vehicles into one array per parameter."""
+    return {k: np.array([veh[k] for veh in vehicles], dtype=float)
+            for k, v in VEHICLE.items() if np.isscalar(v)}
+
+
+@profiling.timed('simulate_batch')
+def simulate_batch(track, vehicles, v0=0., tire=tire_model.TIRE):
+    """Simulate a lap of a discretized track for each of a list of vehicles at once.
+
+    Every vehicle is swept in its own column of (station, vehicle) arrays,
+    with each station stepped for all of them at once, see
+    kernels.forward_sweep_batch(). Returns the summary() channels as a dict
+    of (station, vehicle) arrays, except 'dist', and each column matches
+    simulate() for its vehicle on the same tire.
+    """
+    k = len(vehicles)
+    veh = batch_vehicle(vehicles)
+    envs = [make_ggv(v, make_powertrain(v), tire) for v in vehicles]
+    m = max(len(env['vel']) for env in envs)
+    # lookups clamp at the end of a table, so padding with the last value changes nothing
+    ggv = {key: np.column_stack([np.pad(env[key], (0, m - len(env[key])), mode='edge') for env in envs])
+           for key in ('F_lat_max', 'F_long_max', 'F_drive')}
+    ggv['dv'] = envs[0]['dv']
+    ggv['v_top'] = np.array([env['v_top'] for env in envs])
+
+    n = len(track['len'])
+    radius = np.broadcast_to(np.asarray(track['radius'])[:, None], (n, k))
+    absr = np.abs(track['radius'])
+    vel = np.zeros((n, k))
+    acc = np.zeros((n, k))
+    capped = np.zeros((n, k), dtype=bool)
+    braking = np.zeros((n, k), dtype=bool)
+    args = sweep_args(veh, ggv)
+
+    with profiling.stage('corner_speeds'):
+        # one vehicle at a time, whose working arrays stay in cache where those of a whole batch do not
+        v_corner = np.column_stack([corner_speeds(track['radius'], v, tire=tire) for v in vehicles])
+    with profiling.stage('forward_sweep_batch'):
+        kernels.forward_sweep_batch(vel, acc, capped, absr, v_corner, track['len'], *args,
+                                    ggv['F_drive'], ggv['v_top'], np.full(k, v0))
+    fwd_prev = np.concatenate((np.full((1, k), v0), vel[:-1]))
+    with profiling.stage('backward_sweep_batch'):
+        kernels.backward_sweep_batch(vel, acc, braking, absr, track['len'], *args)
+    v_next = np.concatenate((vel[1:], np.zeros((1, k))))
+    # like the single lap channels, a braking station is seen from the station after it, any other from the forward sweep
+    with profiling.stage('channels_batch'):
+        v_lat = np.where(braking, v_next, fwd_prev)
+        mass = veh['VEHICLE_MASS']
+        a_lat = np.minimum(lat_grip(0.5 * rho * veh['A'] * veh['Cl'] * v_lat, veh, tire),
+                           mass * v_lat**2 / np.abs(radius)) / mass
+
+    v_prev = np.concatenate((np.full((1, k), v0), vel[:-1]))
+    dt = step_time(v_prev, vel, np.asarray(track['len'])[:, None])
+    profiling.count('laps', k)
+    profiling.count('stations', n * k)
+    return {'t': np.cumsum(dt, axis=0),
+            'dt': dt,
+            'dist': track['dist'],
+            'vel': vel,
+            'A_lat': a_lat,
+            'A_long': acc}
+
+
+def summary(s):
+    """Return the headline numbers of a simulated lap, or arrays of them for a batch of setups."""
+    return {'lap_length': s['dist'][-1],
+            'lap_time': s['t'][-1],
+            'max_vel': s['vel'].max(axis=0),
+            'max_A_lat': s['A_lat'].max(axis=0) / G,
+            'max_A_long': s['A_long'].max(axis=0) / G,
+            'min_A_long': s['A_long'].min(axis=0) / G}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    req = parser.add_argument_group('required named arguments')
+    req.add_argument('-f', '--filename', required=True, help='A spline (.npy) or sectioned (.npz) track output by dxf_to_tck.py. ')
+    parser.add_argument('-d', '--delta', type=float, default=0.01, help='The timestep to use for simulation. ')
+    parser.add_argument('-s', '--smooth', type=float, default=None, help='The length in meters to smooth curvature over, by default %s for splines and 0 for sectioned tracks. ' % SMOOTH)
+    parser.add_argument('-t', '--tol', type=float, default=None, help='Space stations adaptively, turning through at most this many radians per step, with --delta as the shortest step. ')
+    parser.add_argument('--max-delta', type=float, default=DD_MAX, help='The longest step allowed by --tol. ')
+    parser.add_argument('-c', '--channels', default=','.join(CHANNELS), help='A comma separated list of channels to keep. ')
+    parser.add_argument('-o', '--output', default=None, help='A .npy file to write the telemetry of every station to. ')
+    parser.add_argument('--no-plot', action='store_true', help='Skip plotting the lap. ')
+    parser.add_argument('-j', '--threads', type=int, default=None, help='Sweep apex to apex segments on this many threads. ')
+    parser.add_argument('--no-cache', action='store_true', help='Rediscretize the track instead of using the track cache. ')
+    parser.add_argument('--ggv', default=None, help='A .csv file to write the g-g-speed envelope of the vehicle to. ')
+    parser.add_argument('-w', '--width', type=float, default=None, help='Simulate the racing line within a track this wide instead of the centreline, see racingline.py. ')
+    parser.add_argument('--profile', default=None, help='A .json file to write the time spent in each stage and the call counts to. ')
+    args = parser.parse_args()
+
+    if args.ggv:
+        save_ggv(args.ggv, make_ggv(VEHICLE, make_powertrain(VEHICLE)))
+
+    plot_mode = "time"  # track or time
+
+    with profiling.record() if args.profile else nullcontext() as stats:
+        track = load_track(args.filename, args.delta, args.smooth, args.tol, args.max_delta, cache=not args.no_cache)
+        print("Generating track with %d stations, step size = %f to %f" % (len(track['len']), track['dd'], max(track['len'])))
+        if args.width:
+            import racingline
+            track = racingline.optimise(track, args.width)
+            print("Racing line length = %s m" % str(round(track['dist'][-1], 2)))
+
+        print("Simulating")
+        channels = dict.fromkeys(SUMMARY + ('x', 'y') + tuple(args.channels.split(',')))
+        pool = ThreadPoolExecutor(args.threads) if args.threads else None
+        s = simulate(track, channels=list(channels), out=args.output, pool=pool, threads=args.threads)
+    if args.profile:
+        stats.save(args.profile)
+        stats.report()
+    res = summary(s)
+
+    print("Lap length = %s m" % str(round(res['lap_length'], 2)))
+    print("Lap time = %s s" % str(round(res['lap_time'], 4)))
+    print("Max velocity = %s m/s" % str(round(res['max_vel'], 3)))
+    print("Max lateral accel = %s g" % str(round(res['max_A_lat'], 3)))
+    print("Max longitudinal accel = %s g" % str(round(res['max_A_long'], 3)))
+    print("Min longitudinal accel = %s g" % str(round(res['min_A_long'], 3)))
+    if args.no_plot:
+        exit()
+
+    import matplotlib.pyplot as plt
+
+    if plot_mode == "track":
+        plt.set_cmap('cool')
+        plt.scatter(s['x'], s['y'], c=np.clip(s['vel'], -30, 30), s=1)
+        plt.axis('equal')
+        plt.colorbar()
+        plt.show()
+    elif plot_mode == "time":
+        plt.scatter(s['t'][:2000], s['vel'][:2000], label="vel")
+        plt.legend(loc='best')
+        plt.show()
@@ -0,0 +1,58 @@
+"""Engine and gearbox lookup tables shared by the simulators."""
+
+from math import pi
+import numpy as np
+import kernels
+import profiling
+
+
+class Powertrain:
+    """Tabulate engine output at the wheels against vehicle speed.
+
+    The tables are built once on a uniform speed grid from zero up to the top
+    speed at the rev limiter in the highest gear, so a query is an array
+    interpolation instead of a scan over the gears and the torque curve.
+    """
+
+    def __init__(self, torque_curve, gear_ratios, final_drive, tire_radius, upshift_RPM, dv=0.01):
+        self.curve_rpm, self.curve_torque = np.array(torque_curve, dtype=float).T
+        self.gear_ratios = np.array(gear_ratios, dtype=float)
+        self.final_drive = final_drive
+        self.tire_radius = tire_radius
+        self.upshift_RPM = upshift_RPM
+        self.dv = dv
+
+        # engine rpm per m/s of vehicle speed in each gear
+        self.rpm_per_vel = 60 * final_drive * self.gear_ratios / (2 * pi * tire_radius)
+        self.shift_vel = upshift_RPM / self.rpm_per_vel[:-1]
+        self.v_top = self.curve_rpm[-1] / self.rpm_per_vel[-1]
+
+        self.vel = np.arange(0, self.v_top + dv, dv)
+        self.gear, self.rpm = self.select_gear(self.vel)
+        self.torque = np.interp(self.rpm, self.curve_rpm, self.curve_torque)
+        self.wheel_torque = self.torque * final_drive * self.gear_ratios[self.gear]
+        self.force = self.wheel_torque / tire_radius
+
+    def select_gear(self, vel):
+        """Return the gear and clamped engine rpm for a speed or an array of speeds."""
+        vel = np.asarray(vel, dtype=float)
+        profiling.count('engine_calls')
+        profiling.count('engine_speeds', vel.size)
+        gear = np.searchsorted(self.shift_vel, vel, side='right')
+        rpm = np.clip(vel * self.rpm_per_vel[gear], self.curve_rpm[0], self.curve_rpm[-1])
+        return gear, rpm
+
+    def query(self, vel):
+        """Return engine parameters for a speed or an array of speeds."""
+        vel = np.asarray(vel, dtype=float)
+        gear, rpm = self.select_gear(vel)
+        return {'gear': gear,
+                'rpm': rpm,
+                'torque': np.interp(vel, self.vel, self.torque),
+                'wheel_torque': np.interp(vel, self.vel, self.wheel_torque),
+                'force': np.interp(vel, self.vel, self.force),
+                'vel': np.minimum(vel, self.v_top)}
+
+    def force_at(self, vel):
+        """Return the wheel force at a single speed without array overhead."""
+        return kernels.lookup(self.force, self.dv, vel)
@@ -0,0 +1,144 @@
+"""Opt-in instrumentation of the simulators.
+
+The solver marks its stages with stage() or timed() and counts calls into the engine
+and tire models with count(). Nothing is recorded unless a run is wrapped in
+record(), so with profiling off each hook is a single global lookup. The
+stats of a run are plain counters and totals, so the stats of many runs,
+such as those of the workers of a sweep, add up into one JSON summary.
+"""
+
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+import json
+import sys
+import time
+
+# the stats being recorded into, if any
+_stats = None
+
+_null = nullcontext()
+
+
+class Stats:
+    """Wall time and calls per stage, and named counters, of one run or of many merged together."""
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+
+    def add_time(self, name, seconds, calls=1):
+        """Add time spent in a stage."""
+        entry = self.stages.setdefault(name, [0, 0.])
+        entry[0] += calls
+        entry[1] += seconds
+
+    def count(self, name, n=1):
+        """Add n to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        """Add the stats of another run, given as Stats or as a dict from as_dict()."""
+        if isinstance(other, Stats):
+            other = other.as_dict()
+        for name, entry in other['stages'].items():
+            self.add_time(name, entry['seconds'], entry['calls'])
+        for name, n in other['counters'].items():
+            self.count(name, n)
+        return self
+
+    def as_dict(self):
+        """Return the stats as plain data that can be sent between processes or written as JSON."""
+        return {'stages': {name: {'calls': calls, 'seconds': seconds}
+                           for name, (calls, seconds) in sorted(self.stages.items(), key=lambda s: -s[1][1])},
+                'counters': dict(sorted(self.counters.items()))}
+
+    def save(self, path):
+        """Write the stats to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def report(self, file=sys.stderr):
+        """Print the stages by total time and then the counters."""
+        for name, entry in self.as_dict()['stages'].items():
+            print("%-20s %8d calls %10.4f s" % (name, entry['calls'], entry['seconds']), file=file)
+        for name, n in self.as_dict()['counters'].items():
+            print("%-20s %8d" % (name, n), file=file)
+
+
+@contextmanager
+def record(stats=None):
+    """Record the stats of everything run inside the block into stats, or a new Stats, and yield it."""
+    global _stats
+    outer = _stats
+    _stats = Stats() if stats is None else stats
+    try:
+        yield _stats
+    finally:
+        _stats = outer
+
+
+def recording():
+    """Return whether stats are being recorded."""
+    return _stats is not None
+
+
+@contextmanager
+def _timed(stats, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_time(name, time.perf_counter() - start)
+
+
+def stage(name):
+    """Return a context manager that times a stage while recording, and does nothing otherwise."""
+    if _stats is None:
+        return _null
+    return _timed(_stats, name)
+
+
+def timed(name):
+    """Decorate a function so that each call is timed as a stage while recording."""
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    """Add n to a counter while recording."""
+    if _stats is not None:
+        _stats.count(name, n)
+
+
+class Progress:
+    """Report how far a loop has got, at most once every interval seconds.
+
+    callback(done, total) is called on update() when the interval has passed
+    since the last report, and always once the loop is done, so a fast loop
+    does not spend its time reporting.
+    """
+
+    def __init__(self, total, callback, interval=0.5):
+        self.total = total
+        self.callback = callback
+        self.interval = interval
+        self.last = -float('inf')
+
+    def update(self, done):
+        """Note that done of total items are finished."""
+        now = time.monotonic()
+        if now - self.last >= self.interval or done == self.total:
+            self.last = now
+            self.callback(done, self.total)
+
+
+def printer(label, file=sys.stdout):
+    """Return a progress callback that rewrites one line of the form done/total label."""
+    def show(done, total):
+        print("\r%d/%d %s" % (done, total, label), end='\n' if done == total else '', file=file, flush=True)
+    return show
@@ -0,0 +1,345 @@
+"""Racing line optimisation within the track width.
+
+The line is placed by its offset from the centreline along the normal at
+every station, between the left and right edges of the track less a margin
+for the car. With the normals fixed, the length of the line is quadratic in
+the offsets, and so is its curvature once the direction across the line is
+taken from an earlier estimate of it. Each refinement of the line is then a
+box constrained QP, whose Hessian is banded, five wide for curvature and three
+for length, plus the corners that close the lap. The QP is solved on
+stations about step apart by a primal-dual interior point method, each
+iteration of which is one sparse factorisation, so the cost grows linearly
+with the station count. A spline through the optimised points, periodic
+round a closed lap, then gives the position and curvature of the line at
+every station. The result is a discretized track like
+pointmass_circuit.discretize() returns, which the circuit solver runs on as
+it is.
+"""
+
+import argparse
+import warnings
+import numpy as np
+from scipy import interpolate, optimize, sparse, spatial
+from scipy.sparse.linalg import spsolve
+import piecewise
+import pointmass_circuit as circuit
+import profiling
+
+# distance in meters kept between the centre of the car and the track edges
+MARGIN = 0.75
+# spacing in meters of the stations the QP is solved on
+STEP = 0.5
+# most QP solves per line, each linearised about the line from the one before
+ITERATIONS = 20
+# fraction of the way to each new solution the line moves
+DAMPING = 0.7
+# range of log10 length weights searched for the minimum time line, see min_time()
+LENGTH_WEIGHTS = (-4., 0.)
+
+
+def closed(track):
+    """Return whether the last station of track leads back round to the first."""
+    gap = np.hypot(track['x'][0] - track['x'][-1], track['y'][0] - track['y'][-1])
+    return gap < 2 * track['len'][-1]
+
+
+def normals(track):
+    """Return the unit left normal of the centreline at every station."""
+    x, y = track['x'], track['y']
+    tx = np.roll(x, -1) - np.roll(x, 1)
+    ty = np.roll(y, -1) - np.roll(y, 1)
+    if not closed(track):
+        tx[0], ty[0] = x[1] - x[0], y[1] - y[0]
+        tx[-1], ty[-1] = x[-1] - x[-2], y[-1] - y[-2]
+    norm = np.hypot(tx, ty)
+    return -ty / norm, tx / norm
+
+
+def widths(track, width):
+    """Return the distance from the centreline to the left and right edges at every station.
+
+    width is the full width of the track, or a (left, right) pair of the
+    distances to either edge, each a number or an array with one per station.
+    """
+    n = len(track['len'])
+    if np.ndim(width) == 0 or np.shape(width) == (n,):
+        left = right = 0.5 * np.asarray(width, dtype=float)
+    else:
+        left, right = width
+    return np.broadcast_to(np.asarray(left, dtype=float), (n,)), np.broadcast_to(np.asarray(right, dtype=float), (n,))
+
+
+def section_widths(trk, width, track):
+    """Return the full width at every station of a track discretized from a sectioned one.
+
+    trk is the sectioned track, see piecewise.load(), and width holds the
+    width of each of its sections, or one width for all of them.
+    """
+    i, _ = piecewise.locate(trk, track['dist'] - track['len'])
+    return np.broadcast_to(np.asarray(width, dtype=float), trk['length'].shape)[i]
+
+
+def boundary_widths(track, left, right):
+    """Return the distance from every station to the left and right edges given as polylines.
+
+    Each edge is an (m, 2) array of points along it. The edges are resampled
+    at the station spacing and the distance to the nearest point is taken,
+    which is the distance along the normal wherever the edge is smooth.
+    """
+    def distance(edge):
+        edge = np.asarray(edge, dtype=float)
+        seg = np.hypot(*np.diff(edge, axis=0).T)
+        along = np.concatenate(([0], np.cumsum(seg)))
+        u = np.linspace(0, along[-1], max(2, int(along[-1] / track['dd']) + 1))
+        points = np.column_stack((np.interp(u, along, edge[:, 0]), np.interp(u, along, edge[:, 1])))
+        return spatial.cKDTree(points).query(np.column_stack((track['x'], track['y'])))[0]
+
+    return distance(left), distance(right)
+
+
+def difference_operators(h, cyclic=True):
+    """Return the first and second difference operators of points h apart around a lap.
+
+    h[i] is the distance from point i to point i + 1. The second difference
+    takes the uneven spacing into account, so both approximate derivatives
+    with respect to distance. Unless cyclic, the rows that would wrap from
+    the last point to the first are left empty.
+    """
+    m = len(h)
+    i = np.arange(m)
+    prev, nxt = np.roll(i, 1), np.roll(i, -1)
+    hp = np.roll(h, 1)
+    d1 = sparse.csr_matrix((np.concatenate((-1 / h, 1 / h)), (np.tile(i, 2), np.concatenate((i, nxt)))),
+                           shape=(m, m))
+    lower = 2 / (hp * (hp + h))
+    upper = 2 / (h * (hp + h))
+    d2 = sparse.csr_matrix((np.concatenate((lower, -lower - upper, upper)),
+                            (np.tile(i, 3), np.concatenate((prev, i, nxt)))), shape=(m, m))
+    if not cyclic:
+        inner = np.ones(m)
+        inner[-1] = 0
+        d1 = sparse.diags(inner) @ d1
+        inner[0] = 0
+        d2 = sparse.diags(inner) @ d2
+    return d1, d2
+
+
+def line_qp(x, y, nx, ny, h, alpha, length_weight=0., cyclic=True):
+    """Return the Hessian and gradient of the line objective in the offsets along the normals.
+
+    The objective is the integral of the squared curvature of the line plus
+    length_weight times the integral of its squared speed, which is least
+    for the shortest line. Curvature is the part of the second difference
+    of the points across the line over the cube of its speed, with the
+    direction across the line and the speed taken from the line with
+    offsets alpha.
+    An open track is not cyclic.
+    """
+    d1, d2 = difference_operators(h, cyclic)
+    px, py = x + alpha * nx, y + alpha * ny
+    span = np.roll(h, 1) + h
+    tx = (np.roll(px, -1) - np.roll(px, 1)) / span
+    ty = (np.roll(py, -1) - np.roll(py, 1)) / span
+    # the normal of the line over the cube of its speed turns second differences into curvature
+    speed3 = (tx**2 + ty**2)**1.5
+    mx, my = sparse.diags(-ty / speed3), sparse.diags(tx / speed3)
+    curv = mx @ d2 @ sparse.diags(nx) + my @ d2 @ sparse.diags(ny)
+    w = sparse.diags(0.5 * span)
+    hess = curv.T @ w @ curv
+    grad = curv.T @ (w @ (mx @ (d2 @ x) + my @ (d2 @ y)))
+    if length_weight:
+        w = sparse.diags(length_weight * h)
+        for r, n in ((x, nx), (y, ny)):
+            a = d1 @ sparse.diags(n)
+            hess = hess + a.T @ w @ a
+            grad = grad + a.T @ (w @ (d1 @ r))
+    # a little weight on the offsets themselves keeps the problem definite on straights
+    hess = hess + sparse.diags(1e-9 * hess.diagonal().mean() * np.ones(len(h)))
+    return hess.tocsr(), grad
+
+
+def box_qp(hess, grad, lo, hi, tol=1e-10, max_iter=100):
+    """Minimise 0.5 x.H.x + g.x subject to lo < x < hi by a primal-dual interior point method.
+
+    Each Newton step solves H plus a diagonal barrier term, which keeps the
+    band of H, so one sparse factorisation per iteration. The steps stop
+    once the duality gap per offset is below tol relative to the size of H.
+    """
+    x = 0.5 * (lo + hi)
+    scale = hess.diagonal().mean()
+    z_lo = np.full(len(x), scale)
+    z_hi = np.full(len(x), scale)
+    for _ in range(max_iter):
+        s_lo, s_hi = x - lo, hi - x
+        mu = (s_lo @ z_lo + s_hi @ z_hi) / (2 * len(x))
+        resid = hess @ x + grad - z_lo + z_hi
+        if mu < tol * scale and np.abs(resid).max() < tol * scale:
+            return x
+        target = 0.1 * mu
+        dx = spsolve((hess + sparse.diags(z_lo / s_lo + z_hi / s_hi)).tocsc(),
+                     -resid + (target / s_lo - z_lo) - (target / s_hi - z_hi))
+        dz_lo = (target - s_lo * z_lo - z_lo * dx) / s_lo
+        dz_hi = (target - s_hi * z_hi + z_hi * dx) / s_hi
+        # go at most 99% of the way to the nearest bound of the offsets and multipliers
+        step = 1.
+        for v, dv in ((s_lo, dx), (s_hi, -dx), (z_lo, dz_lo), (z_hi, dz_hi)):
+            shrink = dv < 0
+            if shrink.any():
+                step = min(step, 0.99 * np.min(-v[shrink] / dv[shrink]))
+        x = x + step * dx
+        z_lo = z_lo + step * dz_lo
+        z_hi = z_hi + step * dz_hi
+    warnings.warn("racing line QP did not converge in %d iterations" % max_iter)
+    return x
+
+
+@profiling.timed('racing_line')
+def optimise(track, width, margin=MARGIN, length_weight=0., step=STEP, tol=0.01, iterations=ITERATIONS):
+    """Return the racing line within width of the centreline of track, as a discretized track.
+
+    width is as for widths(). The line is the minimum curvature one, pulled
+    towards the shortest one by length_weight. The QP is solved about the
+    line from the solve before, up to iterations times, until no offset
+    moves by more than tol. There is a station of the line abreast of
+    each station of the centreline, and the line also carries their offset
+    to the left of the centreline. The spline can swing a few millimetres
+    past the bounds between the QP stations, so those stations are moved
+    back onto the bounds along the normal.
+    """
+    left, right = widths(track, width)
+    nx, ny = normals(track)
+    cyclic = closed(track)
+    start = track['dist'] - track['len']
+    total = track['dist'][-1]
+
+    idx = np.unique(np.minimum(np.searchsorted(start, np.arange(0, total, step)), len(start) - 1))
+    if not cyclic:
+        # an open track keeps its last station so that the line reaches the end
+        idx = np.union1d(idx, [len(start) - 1])
+    h = np.diff(np.append(start[idx], total))
+    lo, hi = margin - right[idx], left[idx] - margin
+    if np.any(lo > hi):
+        raise ValueError("the track is narrower than twice the margin of %g m" % margin)
+    alpha = np.zeros(len(idx))
+    for _ in range(iterations):
+        hess, grad = line_qp(track['x'][idx], track['y'][idx], nx[idx], ny[idx], h, alpha, length_weight, cyclic)
+        change = box_qp(hess, grad, lo, hi) - alpha
+        # damping the steps stops the line swinging back and forth between solves
+        alpha = alpha + DAMPING * change
+        if np.abs(change).max() < tol:
+            break
+
+    # the line through the optimised points, against distance along the centreline
+    points = np.column_stack((track['x'][idx] + alpha * nx[idx], track['y'][idx] + alpha * ny[idx]))
+    if cyclic:
+        spline = interpolate.CubicSpline(np.append(start[idx], total), np.vstack((points, points[:1])), bc_type='periodic')
+    else:
+        spline = interpolate.CubicSpline(start[idx], points)
+    (x, y), (dx, dy), (ddx, ddy) = spline(start).T, spline(start, 1).T, spline(start, 2).T
+    speed = np.hypot(dx, dy)
+    k = (dx * ddy - dy * ddx) / speed**3
+    offset = (x - track['x']) * nx + (y - track['y']) * ny
+    bounded = np.clip(offset, margin - right, left - margin)
+    x, y = x + (bounded - offset) * nx, y + (bounded - offset) * ny
+
+    length = track['len'] * speed
+    with np.errstate(divide='ignore'):
+        radius = -1 / k
+    return {'dd': float(length.min()),
+            'x': x,
+            'y': y,
+            'len': length,
+            'dist': np.cumsum(length),
+            'radius': radius,
+            'offset': bounded}
+
+
+def min_time(track, width, veh=circuit.VEHICLE, margin=MARGIN, step=STEP, weights=LENGTH_WEIGHTS):
+    """Return the line between the minimum curvature and shortest ones that gives the fastest lap.
+
+    The minimum time line lies between the two, so the length weight is
+    searched on a log scale within weights, and against zero weight, for the
+    lowest lap time of veh. The powertrain and g-g-speed envelope are built
+    once for all the laps.
+    """
+    powertrain = circuit.make_powertrain(veh)
+    ggv = circuit.make_ggv(veh, powertrain)
+    lines = {}
+
+    def lap_time(log_weight):
+        weight = 0. if log_weight is None else 10**log_weight
+        lines[weight] = optimise(track, width, margin, weight, step)
+        return circuit.simulate(lines[weight], veh, ('t',), None, powertrain, ggv)['t'][-1]
+
+    best = optimize.minimize_scalar(lap_time, bounds=weights, method='bounded', options={'xatol': 0.05})
+    return lines[0. if lap_time(None) <= best.fun else 10**best.x]
+
+
+def save(path, line):
+    """Write the stations of a racing line to a CSV file."""
+    cols = ('x', 'y', 'offset', 'radius', 'len', 'dist')
+    np.savetxt(path, np.column_stack([line[c] for c in cols]), delimiter=',', header=','.join(cols), comments='')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    req = parser.add_argument_group('required named arguments')
+    req.add_argument('-f', '--filename', required=True, help='A spline (.npy) or sectioned (.npz) track output by dxf_to_tck.py. ')
+    parser.add_argument('-d', '--delta', type=float, default=0.05, help='The station spacing to use for simulation. ')
+    parser.add_argument('-w', '--width', type=float, default=None, help='The full width of the track. ')
+    parser.add_argument('--section-widths', default=None,
+                        help='A comma separated list of the width of each section of a sectioned track, or one width for all. '
+                             'The straight that closes the gap of a closed lap and every clothoid transition count as sections. ')
+    parser.add_argument('--left', default=None, help='A CSV file of x,y points along the left edge of the track. ')
+    parser.add_argument('--right', default=None, help='A CSV file of x,y points along the right edge of the track. ')
+    parser.add_argument('-m', '--margin', type=float, default=MARGIN, help='The distance to keep between the centre of the car and the edges. ')
+    parser.add_argument('--step', type=float, default=STEP, help='The station spacing of the QP. ')
+    parser.add_argument('--length-weight', type=float, default=0., help='Pull the minimum curvature line towards the shortest one by this much. ')
+    parser.add_argument('--min-time', action='store_true', help='Search for the length weight with the fastest lap. ')
+    parser.add_argument('-o', '--output', default=None, help='A .csv file to write the stations of the line to. ')
+    parser.add_argument('--no-plot', action='store_true', help='Skip plotting the line. ')
+    args = parser.parse_args()
+
+    track = circuit.load_track(args.filename, args.delta)
+    if args.left or args.right:
+        if not (args.left and args.right):
+            parser.error("give both --left and --right edges")
+        width = boundary_widths(track, np.loadtxt(args.left, delimiter=',', ndmin=2),
+                                np.loadtxt(args.right, delimiter=',', ndmin=2))
+    elif args.section_widths:
+        if not args.filename.endswith('.npz'):
+            parser.error("--section-widths needs a sectioned (.npz) track")
+        trk = piecewise.load(args.filename)
+        width = [float(w) for w in args.section_widths.split(',')]
+        if len(width) not in (1, len(trk['length'])):
+            parser.error("expected %d section widths, counting the closing straight and clothoid transitions, "
+                         "got %d" % (len(trk['length']), len(width)))
+        width = section_widths(trk, width, track)
+    elif args.width:
+        width = args.width
+    else:
+        parser.error("give the track width with --width, --section-widths or --left and --right")
+
+    if args.min_time:
+        line = min_time(track, width, margin=args.margin, step=args.step)
+    else:
+        line = optimise(track, width, args.margin, args.length_weight, args.step)
+    if args.output:
+        save(args.output, line)
+
+    centre = circuit.summary(circuit.simulate(track, channels=circuit.SUMMARY))
+    res = circuit.summary(circuit.simulate(line, channels=circuit.SUMMARY))
+    print("Centreline: length = %s m, lap time = %s s" % (str(round(centre['lap_length'], 2)), str(round(centre['lap_time'], 4))))
+    print("Racing line: length = %s m, lap time = %s s" % (str(round(res['lap_length'], 2)), str(round(res['lap_time'], 4))))
+    if args.no_plot:
+        exit()
+
+    import matplotlib.pyplot as plt
+
+    plt.plot(track['x'], track['y'], 'k', lw=0.5, label='centreline')
+    plt.set_cmap('plasma')
+    plt.scatter(line['x'], line['y'], c=np.minimum(np.abs(line['radius']), 50), s=1, label='racing line')
+    plt.axis('equal')
+    plt.colorbar()
+    plt.legend(loc='best')
+    plt.show()
@@ -0,0 +1,139 @@
+"""Simulate an endurance stint of many laps, burning fuel as it goes."""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pointmass_circuit as circuit
+
+# length of an FSAE endurance event in meters
+ENDURANCE = 22000.
+
+# fuel system parameters
+FUEL = {'fuel_mass': 4.5,  # fuel at the start of the stint in kg, included in VEHICLE_MASS
+        'driveline_efficiency': 0.85,  # share of the engine output that reaches the tires
+        'bsfc': [(7000, 310.),  # (rpm, g/kWh)
+                 (8000, 300.),
+                 (9000, 305.),
+                 (10000, 320.)]}
+
+# record layout of the per-lap results
+LAP = np.dtype([('lap', np.int64), ('t', np.float64), ('v_start', np.float64), ('v_end', np.float64),
+                ('mass', np.float64), ('energy', np.float64), ('fuel_used', np.float64),
+                ('fuel', np.float64), ('solved', np.bool_)])
+
+
+def wrap(track, veh=circuit.VEHICLE, powertrain=None):
+    """Return track with the stations after the finish line up to the first apex appended.
+
+    Braking for a corner just after the line then starts on the lap before,
+    and the lap itself is the first len(track['len']) stations. Only apexes
+    of veh that are slower than its top speed count, so noise in the
+    curvature of a straight is not taken for a corner.
+    """
+    if powertrain is None:
+        powertrain = circuit.make_powertrain(veh)
+    v_corner = circuit.corner_speeds(track['radius'], veh)
+    a = circuit.apexes(v_corner)
+    a = a[v_corner[a] < powertrain.v_top]
+    m = a[0] + 1 if len(a) else 0
+    ext = {k: np.concatenate((track[k], track[k][:m])) for k in ('x', 'y', 'len', 'radius')}
+    ext['dist'] = np.concatenate((track['dist'], track['dist'][-1] + track['dist'][:m]))
+    ext['dd'] = track['dd']
+    return ext
+
+
+def lap_energy(vel, ds, v0, veh, powertrain, fuel=FUEL):
+    """Return the energy the engine puts out over a lap in joules, and the fuel that burns in kg.
+
+    The work at the tires over each step is the gain in kinetic energy plus
+    the drag, and none is done over steps that lose more speed than drag
+    alone would take.
+    """
+    v_prev = np.concatenate(([v0], vel[:-1]))
+    v_mean = 0.5 * (v_prev + vel)
+    k_drag = 0.5 * circuit.rho * veh['A'] * veh['Cd']
+    work = 0.5 * veh['VEHICLE_MASS'] * (vel**2 - v_prev**2) + k_drag * v_mean * ds
+    energy = np.maximum(work, 0.) / fuel['driveline_efficiency']
+
+    _, rpm = powertrain.select_gear(v_mean)
+    bsfc_rpm, bsfc = np.array(fuel['bsfc'], dtype=float).T
+    burn = energy * np.interp(rpm, bsfc_rpm, bsfc) / 3.6e9
+    return energy.sum(), burn.sum()
+
+
+def simulate(track, veh=circuit.VEHICLE, laps=None, fuel=FUEL, mass_tol=0.25, speed_tol=0.01, pool=None,
+             threads=None, powertrain=None, make_ggv=circuit.make_ggv):
+    """Simulate a stint of laps from a standing start and return one record per lap.
+
+    Every lap after the first is a rolling start from the end speed of the
+    one before, and the car gets lighter by the fuel each lap burns. A lap is
+    only solved again once its mass or start speed has moved more than
+    mass_tol or speed_tol from the last lap that was solved. Otherwise the
+    time, end speed and fuel use of that lap are reused, so a stint costs a handful of laps no matter
+    how long it is. laps defaults to enough to cover an endurance event.
+
+    The envelope of each lap's vehicle comes from make_ggv(veh, powertrain),
+    which can be a cache shared with other runs of the same vehicle.
+    """
+    if powertrain is None:
+        powertrain = circuit.make_powertrain(veh)
+    ext = wrap(track, veh, powertrain)
+    n = len(track['len'])
+    if laps is None:
+        laps = int(np.ceil(ENDURANCE / track['dist'][-1]))
+
+    res = np.zeros(laps, dtype=LAP)
+    fuel_left = fuel['fuel_mass']
+    v0 = 0.
+    last = None
+    for i in range(laps):
+        mass = veh['VEHICLE_MASS'] - (fuel['fuel_mass'] - fuel_left)
+        r = res[i]
+        if last is None or abs(mass - last['mass']) > mass_tol or abs(v0 - last['v_start']) > speed_tol:
+            lap_veh = dict(veh, VEHICLE_MASS=mass)
+            s = circuit.simulate(ext, lap_veh, ('t', 'vel'), powertrain=powertrain,
+                                 ggv=make_ggv(lap_veh, powertrain), pool=pool, threads=threads,
+                                 v0=v0)[:n]
+            r['t'] = s['t'][-1]
+            r['v_end'] = s['vel'][-1]
+            r['energy'], r['fuel_used'] = lap_energy(s['vel'], track['len'], v0, lap_veh, powertrain, fuel)
+            r['solved'] = True
+            last = r
+        else:
+            for k in ('t', 'v_end', 'energy', 'fuel_used'):
+                r[k] = last[k]
+        r['lap'] = i + 1
+        r['v_start'] = v0
+        r['mass'] = mass
+        fuel_left -= r['fuel_used']
+        r['fuel'] = fuel_left
+        v0 = r['v_end']
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    req = parser.add_argument_group('required named arguments')
+    req.add_argument('-f', '--filename', required=True, help='A spline (.npy) or sectioned (.npz) track output by dxf_to_tck.py. ')
+    parser.add_argument('-d', '--delta', type=float, default=0.01, help='The station spacing to use for simulation. ')
+    parser.add_argument('-t', '--tol', type=float, default=None, help='Space stations adaptively, see pointmass_circuit.py. ')
+    parser.add_argument('-n', '--laps', type=int, default=None, help='The number of laps, by default enough for %d m. ' % ENDURANCE)
+    parser.add_argument('--fuel', type=float, default=FUEL['fuel_mass'], help='The fuel at the start in kg. ')
+    parser.add_argument('--mass-tol', type=float, default=0.25, help='Solve a lap again once the car is this many kg lighter. ')
+    parser.add_argument('-o', '--output', default=None, help='A .npy file to write the per-lap results to. ')
+    parser.add_argument('-j', '--threads', type=int, default=None, help='Sweep apex to apex segments on this many threads. ')
+    args = parser.parse_args()
+
+    track = circuit.load_track(args.filename, args.delta, tol=args.tol)
+    pool = ThreadPoolExecutor(args.threads) if args.threads else None
+    res = simulate(track, laps=args.laps, fuel=dict(FUEL, fuel_mass=args.fuel), mass_tol=args.mass_tol, pool=pool,
+                   threads=args.threads)
+    if args.output:
+        np.save(args.output, res)
+
+    print("Laps = %d, %d solved" % (len(res), res['solved'].sum()))
+    print("Stint time = %s s" % str(round(res['t'].sum(), 3)))
+    print("First lap = %s s, fastest lap = %s s" % (str(round(res['t'][0], 4)), str(round(res['t'].min(), 4))))
+    print("Fuel used = %s kg" % str(round(res['fuel_used'].sum(), 3)))
+    if res['fuel'][-1] < 0:
+        print("Ran out of fuel on lap %d" % res['lap'][np.argmax(res['fuel'] < 0)])
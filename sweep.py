@@ -0,0 +1,205 @@
+"""Run the circuit simulation over many vehicle setups in parallel."""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.stats import qmc
+import pointmass_circuit as circuit
+import profiling
+import telemetry
+
+# lap results stored for every setup, see circuit.summary()
+RESULTS = ('lap_length', 'lap_time', 'max_vel', 'max_A_lat', 'max_A_long', 'min_A_long')
+
+# per-worker state, set once by _init so the track is not resent with every setup
+_track = None
+_base = None
+_channels = circuit.SUMMARY
+_laps = None
+_profile = False
+
+
+def grid(space):
+    """Return every combination of the values listed for each parameter."""
+    names = list(space)
+    return [dict(zip(names, values)) for values in product(*(space[n] for n in names))]
+
+
+def latin_hypercube(bounds, n, seed=None):
+    """Return n setups sampled by Latin hypercube within (low, high) bounds per parameter."""
+    names = list(bounds)
+    low, high = np.array([bounds[k] for k in names], dtype=float).T
+    samples = qmc.scale(qmc.LatinHypercube(d=len(names), seed=seed).random(n), low, high)
+    return [dict(zip(names, row)) for row in samples.tolist()]
+
+
+def vehicle(base, params):
+    """Return base with the swept parameters set, see circuit.parameter()."""
+    return dict(base, **circuit.parameter_changes(base, params))
+
+
+def result_dtype(params):
+    """Build the record layout of the output file from the first parameter set."""
+    fields = [('index', np.int64)]
+    fields += [(k, np.float64, np.shape(v)) for k, v in params.items()]
+    fields += [(k, np.float64) for k in RESULTS]
+    return np.dtype(fields)
+
+
+def _init(filename, dd, base, channels, laps, profile=False):
+    """Memory-map the cached track and lap telemetry and keep the base vehicle in a worker process."""
+    global _track, _base, _channels, _laps, _profile
+    _track = circuit.load_track(filename, dd)
+    _base = base
+    _channels = channels
+    _laps = None if laps is None else np.load(laps, mmap_mode='r+')
+    _profile = profile
+
+
+def _task(func, *args):
+    """Run func(*args) in a worker process, returning its result and, when profiling, the stats of the run."""
+    if not _profile:
+        return func(*args), None
+    with profiling.record() as stats:
+        result = func(*args)
+    return result, stats.as_dict()
+
+
+def _run(index, params):
+    """Simulate one setup in a worker process, writing its telemetry straight into its row of the lap file."""
+    veh = vehicle(_base, params)
+    s = circuit.simulate(_track, veh, _channels, None if _laps is None else _laps[index])
+    return index, circuit.summary(s)
+
+
+def _run_batch(indices, param_sets):
+    """Simulate a batch of setups together in a worker process, see circuit.simulate_batch()."""
+    b = circuit.simulate_batch(_track, [vehicle(_base, p) for p in param_sets])
+    if _laps is not None:
+        for j, index in enumerate(indices):
+            telemetry.store(_laps[index], {k: v if k == 'dist' else v[:, j] for k, v in b.items()})
+    res = circuit.summary(b)
+    return [(index, {k: res[k] if np.ndim(res[k]) == 0 else res[k][j] for k in RESULTS})
+            for j, index in enumerate(indices)]
+
+
+def run(filename, dd, param_sets, out, base=circuit.VEHICLE, workers=None, laps=None, channels=(), batch=None,
+        stats=None, progress=None):
+    """Simulate every parameter set and stream the results into a .npy file as they finish.
+
+    The output is a structured array with one record per setup, holding its
+    index, the swept parameters and the lap results. It is written through a
+    memory map, so finished rows are on disk while the sweep is still running
+    and a large sweep never has to be held in memory.
+
+    If laps names a .npy file, the per-station telemetry of every lap is kept
+    there too, as a (setup, station) structured array of the given channels
+    plus those summary() needs.
+
+    Given a batch size, each worker sweeps that many setups at once as
+    columns of one array, see circuit.simulate_batch(). Batched laps only
+    keep the summary() channels.
+
+    Given a profiling.Stats, the stage times and call counts of every worker
+    are added up into it. progress is called as progress(done, total), see
+    profiling.Progress.
+    """
+    param_sets = list(param_sets)
+    channels = list(dict.fromkeys(circuit.SUMMARY + tuple(channels)))
+    if batch and len(channels) > len(circuit.SUMMARY):
+        raise ValueError("batched sweeps only keep the channels %s" % ', '.join(circuit.SUMMARY))
+    # build the track cache once here so that every worker only maps it
+    track = circuit.load_track(filename, dd)
+    results = open_memmap(out, mode='w+', dtype=result_dtype(param_sets[0]), shape=(len(param_sets),))
+    results['lap_time'] = np.nan
+    if laps is not None:
+        dtype = telemetry.layout(channels, circuit.CHANNELS, circuit.CHANNEL_TYPES)
+        # create the file here, workers then map it and fill in one row each
+        open_memmap(laps, mode='w+', dtype=dtype, shape=(len(param_sets), len(track['len']))).flush()
+
+    initargs = (filename, dd, base, channels, laps, stats is not None)
+    progress = profiling.Progress(len(param_sets), progress or profiling.printer('setups'))
+    with ProcessPoolExecutor(workers, initializer=_init, initargs=initargs) as pool:
+        if batch:
+            futures = [pool.submit(_task, _run_batch, range(i, min(i + batch, len(param_sets))), param_sets[i:i + batch])
+                       for i in range(0, len(param_sets), batch)]
+        else:
+            futures = [pool.submit(_task, _run, i, p) for i, p in enumerate(param_sets)]
+        done = 0
+        for future in as_completed(futures):
+            finished, task_stats = future.result()
+            if task_stats is not None:
+                stats.merge(task_stats)
+            for index, res in (finished if batch else [finished]):
+                results['index'][index] = index
+                for k, v in param_sets[index].items():
+                    results[k][index] = v
+                for k in RESULTS:
+                    results[k][index] = res[k]
+                done += 1
+                if done % 100 == 0:
+                    results.flush()
+            progress.update(done)
+    results.flush()
+    return results
+
+
+def parse_values(spec):
+    """Split a name=v1,v2,... option into a name and a list of floats."""
+    name, values = spec.split('=')
+    return name, [float(v) for v in values.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    req = parser.add_argument_group('required named arguments')
+    req.add_argument('-f', '--filename', required=True, help='A numpy file output by dxf_to_tck.py. ')
+    req.add_argument('-o', '--output', required=True, help='The .npy file to write results to. ')
+    parser.add_argument('-d', '--delta', type=float, default=0.01, help='The station spacing to use for simulation. ')
+    parser.add_argument('-g', '--grid', action='append', default=[], metavar='NAME=V1,V2,...',
+                        help='Sweep a vehicle parameter over a list of values. Can be repeated. ')
+    parser.add_argument('-l', '--lhs', action='append', default=[], metavar='NAME=LOW,HIGH',
+                        help='Sample a vehicle parameter between two bounds. Can be repeated. ')
+    parser.add_argument('-n', '--samples', type=int, default=100, help='The number of Latin hypercube samples. ')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='The seed for Latin hypercube sampling. ')
+    parser.add_argument('-t', '--telemetry', default=None, help='A .npy file to keep the per-station telemetry of every lap in. ')
+    parser.add_argument('-c', '--channels', default='', help='A comma separated list of extra channels to keep with --telemetry. ')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='The number of worker processes. ')
+    parser.add_argument('-b', '--batch', type=int, default=None, help='Sweep this many setups at once in each worker. ')
+    parser.add_argument('--profile', default=None, help='A .json file to write the stage times and call counts of all workers to. ')
+    args = parser.parse_args()
+
+    if bool(args.grid) == bool(args.lhs):
+        parser.error("specify either --grid or --lhs parameters")
+    if args.batch and args.channels:
+        parser.error("--batch only keeps the channels %s" % ', '.join(circuit.SUMMARY))
+
+    for name, _ in map(parse_values, args.grid + args.lhs):
+        gear = circuit.GEAR.fullmatch(name)
+        if gear:
+            if int(gear.group(1)) >= len(circuit.VEHICLE['gear_ratios']):
+                parser.error("there is no gear %s" % gear.group(1))
+        elif name not in circuit.VEHICLE:
+            parser.error("unknown vehicle parameter '%s'" % name)
+        elif not np.isscalar(circuit.VEHICLE[name]):
+            parser.error("'%s' is a list, sweep single gears as gear_ratios[i]" % name)
+
+    if args.grid:
+        param_sets = grid(dict(map(parse_values, args.grid)))
+    else:
+        param_sets = latin_hypercube(dict(map(parse_values, args.lhs)), args.samples, args.seed)
+
+    print("Simulating %d setups" % len(param_sets))
+    stats = profiling.Stats() if args.profile else None
+    results = run(args.filename, args.delta, param_sets, args.output, workers=args.workers,
+                  laps=args.telemetry, channels=[c for c in args.channels.split(',') if c], batch=args.batch,
+                  stats=stats)
+    if stats is not None:
+        stats.save(args.profile)
+        stats.report()
+    best = results[np.nanargmin(results['lap_time'])]
+    print("Best lap time = %s s with %s" % (str(round(best['lap_time'], 4)),
+                                            {k: best[k].tolist() for k in param_sets[0]}))
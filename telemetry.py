@@ -0,0 +1,74 @@
+"""Preallocated telemetry buffers shared by the simulators.
+
+A run's telemetry is a single structured array with one record per step or
+station and one field per channel. It is allocated once at its final size
+from the station count, and only the channels a run asks for are allocated,
+so memory grows with the channels kept rather than with everything the
+solver can report.
+
+A buffer can also be a memory-mapped .npy file, in which case the solver
+writes its channels straight to disk as it fills them in and a finished run
+can be reloaded with np.load(path, mmap_mode='r').
+"""
+
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+def layout(channels, available, types=None):
+    """Return the record dtype of the requested channels, checking that they exist."""
+    unknown = [c for c in channels if c not in available]
+    if unknown:
+        raise ValueError("unknown telemetry channels: %s" % ', '.join(unknown))
+    types = types or {}
+    return np.dtype([(c, types.get(c, np.float64)) for c in channels])
+
+
+def allocate(n, channels, available, types=None, out=None):
+    """Return a zeroed buffer of n records holding the requested channels.
+
+    out may be the name of a .npy file to map the buffer onto, or an existing
+    array of the same layout to fill in, such as one row of a larger map.
+    """
+    dtype = layout(channels, available, types)
+    if out is None:
+        return np.zeros(n, dtype=dtype)
+    if isinstance(out, (str, os.PathLike)):
+        return open_memmap(out, mode='w+', dtype=dtype, shape=(n,))
+    if out.dtype != dtype or out.shape != (n,):
+        raise ValueError("output buffer holds %s %s records, expected %d %s" % (out.shape, out.dtype, n, dtype))
+    out[...] = 0
+    return out
+
+
+def resize(buf, n):
+    """Return buf cut or zero padded to n records.
+
+    A buffer mapped onto a whole .npy file by allocate() is copied into a new
+    file that then replaces the old one.
+    """
+    m = min(n, len(buf))
+    if isinstance(buf, np.memmap) and buf.filename:
+        path = buf.filename
+        tmp = '%s.%d.tmp.npy' % (os.path.splitext(path)[0], os.getpid())
+        new = open_memmap(tmp, mode='w+', dtype=buf.dtype, shape=(n,))
+        new[:m] = buf[:m]
+        new.flush()
+        os.replace(tmp, path)
+        return new
+    new = np.zeros(n, dtype=buf.dtype)
+    new[:m] = buf[:m]
+    return new
+
+
+def wants(buf, channels):
+    """Return whether buf holds any of the channels."""
+    return not set(buf.dtype.names).isdisjoint(channels)
+
+
+def store(buf, values, where=slice(None)):
+    """Copy every channel of values that buf holds into the records selected by where."""
+    for key in buf.dtype.names:
+        if key in values:
+            buf[key][where] = values[key]
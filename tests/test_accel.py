@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+import pointmass_accel as accel
+import telemetry
+
+
+@pytest.fixture
+def coarse(monkeypatch):
+    """Take fewer, longer steps so a run is quick."""
+    monkeypatch.setattr(accel, 'DT', 1e-3)
+    monkeypatch.setattr(accel, 'finish_mode', 'distance')
+
+
+def buffer(n):
+    return telemetry.allocate(n, accel.CHANNELS, accel.CHANNELS, accel.CHANNEL_TYPES)
+
+
+def test_euler_fills_out_in_place(coarse):
+    out = buffer(int(accel.finish_time / accel.DT) + 2)
+    res = accel.euler(out=out)
+    assert np.shares_memory(res, out)
+    assert np.array_equal(res, out[:len(res)])
+    assert np.array_equal(res, accel.euler())
+
+
+def test_euler_raises_when_out_is_too_short(coarse, monkeypatch):
+    monkeypatch.setattr(accel, 'finish_time', 1)
+    with pytest.raises(ValueError):
+        accel.euler(out=buffer(int(accel.finish_time / accel.DT) + 2))
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import lapsim
+import pointmass_circuit as circuit
+import tires
+
+
+def evenly_spaced(radius, dd):
+    """Return a discretized track of the given radii at every station dd apart."""
+    n = len(radius)
+    return {'dd': dd,
+            'x': np.zeros(n),
+            'y': np.zeros(n),
+            'len': np.full(n, dd),
+            'dist': dd * np.arange(1, n + 1),
+            'radius': np.asarray(radius, dtype=float)}
+
+
+@pytest.mark.parametrize('dd, dd_max', [(0.05, 1.), (0.03, 1.), (0.1, 0.7), (0.25, 2.), (0.1, 0.15)])
+def test_adapt_keeps_steps_within_dd_max(dd, dd_max):
+    radius = np.full(4000, np.inf)
+    radius[2000:2400] = 10.
+    track = circuit.adapt(evenly_spaced(radius, dd), 0.01, dd_max)
+    assert np.diff(track['dist'], prepend=0).max() <= dd_max
+    assert track['dist'][-1] == pytest.approx(4000 * dd)
+
+
+def test_simulate_batch_matches_simulate():
+    radius = np.full(3000, np.inf)
+    radius[1000:1300] = 12.
+    radius[2200:2300] = -6.
+    track = evenly_spaced(radius, 0.1)
+    vehicles = [dict(circuit.VEHICLE, Cl=cl, VEHICLE_MASS=mass, final_drive=fd)
+                for cl, mass, fd in ((0.9, 240., 7.), (1.3, 265., 8.5), (1.6, 280., 6.5))]
+    batch = circuit.simulate_batch(track, vehicles)
+    for j, veh in enumerate(vehicles):
+        s = circuit.simulate(track, veh, circuit.SUMMARY)
+        for channel in ('t', 'vel', 'A_lat', 'A_long'):
+            assert np.array_equal(batch[channel][:, j], s[channel])
+
+
+def test_tire_changes_lap_time():
+    radius = np.full(3000, np.inf)
+    radius[1000:1300] = 12.
+    track = evenly_spaced(radius, 0.1)
+    grippy = dict(tires.TIRE, table=((0., 1.8, 1.8), (2000., 1.6, 1.6)))
+    base = circuit.simulate(track, channels=circuit.SUMMARY)['t'][-1]
+    faster = circuit.simulate(track, channels=circuit.SUMMARY, tire=grippy)['t'][-1]
+    assert faster < base
+    assert lapsim.LapSimulator(tire=grippy).lap_time(track) == faster
+    assert circuit.simulate_batch(track, [circuit.VEHICLE], tire=grippy)['t'][-1, 0] == faster
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+import racingline
+
+
+def lobed(dd=0.1):
+    """Return a closed track with three lobes and a ripple, discretized every dd."""
+    theta = np.linspace(0, 2 * np.pi, 20001)
+    r = 30 + 8 * np.cos(3 * theta) + 3 * np.sin(7 * theta)
+    x, y = r * np.cos(theta), r * np.sin(theta)
+    along = np.concatenate(([0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+    u = np.arange(0, along[-1], dd)
+    x, y = np.interp(u, along, x), np.interp(u, along, y)
+    length = np.hypot(np.roll(x, -1) - x, np.roll(y, -1) - y)
+    dx, dy = np.gradient(x), np.gradient(y)
+    k = (dx * np.gradient(dy) - dy * np.gradient(dx)) / np.hypot(dx, dy)**3
+    return {'dd': dd, 'x': x, 'y': y, 'len': length, 'dist': np.cumsum(length), 'radius': -1 / k}
+
+
+@pytest.mark.parametrize('width', [3., 4., 6.])
+def test_line_stays_within_the_margin(width):
+    track = lobed()
+    line = racingline.optimise(track, width)
+    bound = width / 2 - racingline.MARGIN
+    assert np.abs(line['offset']).max() <= bound
+    nx, ny = racingline.normals(track)
+    assert np.allclose((line['x'] - track['x']) * nx + (line['y'] - track['y']) * ny, line['offset'])
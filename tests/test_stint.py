@@ -0,0 +1,33 @@
+import numpy as np
+import pointmass_circuit as circuit
+import stint
+
+
+def first_corner_past_line(dd=0.1):
+    """Return a lap of noisy straights with its first corner 10 m past the line."""
+    rng = np.random.default_rng(0)
+    radius = 1 / rng.uniform(1e-5, 1e-4, 4000)
+    # a spline often leaves a spurious gentle curve at the line
+    radius[0] = 400.
+    radius[100:350] = 8.
+    n = len(radius)
+    return {'dd': dd,
+            'x': np.zeros(n),
+            'y': np.zeros(n),
+            'len': np.full(n, dd),
+            'dist': dd * np.arange(1, n + 1),
+            'radius': radius}
+
+
+def test_wrap_reaches_the_first_corner():
+    track = first_corner_past_line()
+    ext = stint.wrap(track)
+    assert len(ext['len']) > len(track['len']) + 100
+
+
+def test_stint_brakes_across_the_line():
+    track = first_corner_past_line()
+    res = stint.simulate(track, laps=2)
+    flying = circuit.simulate(track, channels=('vel',))['vel'][-1]
+    assert res['v_end'][0] < flying
+    assert res['v_start'][1] == res['v_end'][0]
@@ -0,0 +1,44 @@
+"""Load sensitive tire friction for the circuit solver.
+
+Friction falls off as a tire is loaded harder. Each axle carries two tires
+that share its load evenly, since weight transfer is not modelled. The
+circuit solver tabulates the grip of both axles against speed once per
+vehicle, see pointmass_circuit.make_ggv(), so the sweeps only interpolate a
+table at each station.
+"""
+
+import numpy as np
+import profiling
+
+# tire parameters, the peak friction coefficients follow the Pacejka form
+# mu = pD1 + pD2 * dfz with dfz = (Fz - Fz0) / Fz0
+TIRE = {'Fz0': 650.,  # nominal load of one tire in N
+        'pDy1': 1.5,  # lateral friction at the nominal load
+        'pDy2': -0.08,  # change in lateral friction per unit of load above nominal
+        'pDx1': 1.5,  # longitudinal friction at the nominal load
+        'pDx2': -0.08,  # change in longitudinal friction per unit of load above nominal
+        # measured (Fz, mu_lat, mu_long) points, e.g. from TTC data, replace the fit when given
+        'table': None}
+
+
+def mu(fz, tire=TIRE):
+    """Return the lateral and longitudinal friction coefficients of one tire at load fz."""
+    fz = np.asarray(fz, dtype=float)
+    profiling.count('tire_calls')
+    profiling.count('tire_loads', fz.size)
+    if tire['table'] is not None:
+        fz_data, lat, long = np.array(tire['table'], dtype=float).T
+        return np.interp(fz, fz_data, lat), np.interp(fz, fz_data, long)
+    dfz = (fz - tire['Fz0']) / tire['Fz0']
+    return (np.maximum(tire['pDy1'] + tire['pDy2'] * dfz, 0.),
+            np.maximum(tire['pDx1'] + tire['pDx2'] * dfz, 0.))
+
+
+def axle_lat(fn, tire=TIRE):
+    """Return the peak lateral force of an axle with normal load fn."""
+    return fn * mu(0.5 * fn, tire)[0]
+
+
+def axle_long(fn, tire=TIRE):
+    """Return the peak longitudinal force of an axle with normal load fn."""
+    return fn * mu(0.5 * fn, tire)[1]
@@ -0,0 +1,56 @@
+"""On-disk cache of discretized tracks.
+
+Discretizing a spline track only depends on the spline file, the station
+spacing and a few options, so the result is stored once per combination and
+memory-mapped on later runs. Every channel is a contiguous row of a single
+.npy file, so parallel workers share the same pages instead of each holding a
+copy of the track.
+"""
+
+import hashlib
+import os
+import numpy as np
+import profiling
+
+# bump whenever the discretization changes so that stale entries are rebuilt
+VERSION = 2
+
+# per-station channels stored in the cache, one row each
+CHANNELS = ('x', 'y', 'radius', 'len', 'dist')
+
+
+def cache_key(filename, dd, **options):
+    """Hash the spline file contents together with the spacing and discretization options."""
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(repr((VERSION, float(dd), sorted(options.items()))).encode())
+    return h.hexdigest()[:16]
+
+
+def cache_path(filename, dd, cache_dir=None, **options):
+    """Return where the discretized track for filename and dd is stored."""
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), '.trackcache')
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(cache_dir, '%s-%s.npy' % (stem, cache_key(filename, dd, **options)))
+
+
+def load(filename, dd, build, cache_dir=None, **options):
+    """Return the discretized track, calling build(filename, dd, **options) and storing the result on a miss."""
+    path = cache_path(filename, dd, cache_dir, **options)
+    hit = os.path.exists(path)
+    profiling.count('track_cache_hits' if hit else 'track_cache_misses')
+    if not hit:
+        track = build(filename, dd, **options)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write under a private name first so concurrent runs never read a partial file
+        tmp = '%s.%d.tmp.npy' % (path[:-4], os.getpid())
+        np.save(tmp, np.stack([track[key] for key in CHANNELS]))
+        os.replace(tmp, path)
+
+    rows = np.load(path, mmap_mode='r')
+    track = dict(zip(CHANNELS, rows))
+    track['dd'] = float(track['len'].min())
+    return track